@@ -0,0 +1,105 @@
+"""
+Memory benchmark: how many bytes per object the state that a scraper keeps for every object of a run takes,
+measured with tracemalloc on generated inputs.
+
+- zotero: the rows of a Zotero export as read (only held all at once in delta mode, for the pending objects)
+- journal: the resume journal of a finished run
+- delta: the manifest of the last delta run and the delta of an unchanged export
+- tar index: the stored files of every record of a tar shard output
+- records: scraped objects (only the ones in flight are alive while scraping)
+
+Usage: python benchmarks/memory.py [-n OBJECTS]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from varscrap.converters.zotero import read_csv  # noqa: E402
+from varscrap.delta import Manifest  # noqa: E402
+from varscrap.journal import Journal  # noqa: E402
+from varscrap.scrapers.wallace_collection import WallaceCollectionInformation  # noqa: E402
+from varscrap.shards import TarShardSink  # noqa: E402
+
+PATTERN = r"objectId=(?P<objectId>[0-9]+)"
+
+
+def measure(function):
+    """
+    :return: the result of function and the bytes it allocated and still holds
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def generate(folder, n):
+    with open(os.path.join(folder, "export.csv"), 'w', encoding='utf-8') as fo:
+        fo.write("Key,Item Type,Url,Title,Manual Tags,Date Modified\n")
+        for i in range(n):
+            fo.write(f"K{i:07d},artwork,http://wallacelive.wallacecollection.org/eMuseumPlus?service="
+                     f"ExternalInterface&module=collection&objectId={i}&viewType=detailView,"
+                     f"\"Portrait of a lady, number {i}\",tag{i % 5},2020-01-01 10:00:00\n")
+    with open(os.path.join(folder, "journal.log"), 'w') as fo:
+        for i in range(n):
+            fo.write(f"metadata\t{i}\nimage\t{i}\n")
+    os.makedirs(os.path.join(folder, "shards"))
+    with open(os.path.join(folder, "shards", "index.jsonl"), 'w') as fo:
+        for i in range(n):
+            fo.write(json.dumps({'id': str(i), 'key': str(i), 'shard': "shard-000000.tar", 'files': [
+                {'name': f"{i}.json", 'offset': 512, 'size': 600},
+                {'name': f"{i}.jpg", 'offset': 2048, 'size': 100000}]}) + "\n")
+    manifest = Manifest(os.path.join(folder, "manifest.jsonl"))
+    manifest.diff(export(folder), done=())
+    manifest.commit()
+
+
+def export(folder):
+    return (obj for chunk in read_csv(os.path.join(folder, "export.csv"), PATTERN) for obj in chunk)
+
+
+def delta(folder):
+    manifest = Manifest(os.path.join(folder, "manifest.jsonl"))
+    ids = set()
+    return manifest, manifest.diff((ids.add(obj.object_id) or obj for obj in export(folder)), done=ids)
+
+
+def records(n):
+    objects = []
+    for i in range(n):
+        info = WallaceCollectionInformation(
+            object_id=str(i), object_name="Painting", title=f"Portrait of a lady, number {i}", reference="",
+            reference_data="", place_artist="Dutch", dates_all="1650", material="Oil on canvas",
+            dimensions="50 x 40 cm", marks="", museum_number=f"P{i}", commentary="")
+        info.tag = "tag"
+        objects.append(info)
+    return objects
+
+
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("-n", "--objects", type=int, default=100000, help="Number of objects")
+    args = cli.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        generate(folder, args.objects)
+        print(f"{'state':<10} {'bytes/object':>12}")
+        for name, function in (('zotero', lambda: list(export(folder))),
+                               ('journal', lambda: Journal(os.path.join(folder, "journal.log"))),
+                               ('delta', lambda: delta(folder)),
+                               ('tar index', lambda: TarShardSink(os.path.join(folder, "shards"))),
+                               ('records', lambda: records(args.objects))):
+            result, size = measure(function)
+            print(f"{name:<10} {size / args.objects:>12.1f}")
+            if hasattr(result, 'close'):
+                result.close()
+            del result
@@ -0,0 +1,318 @@
+"""
+End-to-end benchmark of the scrapers against a local stand-in for the museum sites.
+
+The pages and API responses in benchmarks/fixtures are replayed by a local HTTP server with an injected latency,
+every request of a scraper is redirected to it, so no network access is needed. The object id of a fixture
+(the number in its file name) is replaced by the requested one, so any number of distinct items can be served.
+
+For every scraper, the number of items per second, the latency per item (from the first request of an item
+to the end of its last response, as seen by the server) and the peak RSS of the scraping process are reported.
+
+With --variant, the scrapers make the given image variants and a real 2000x1500 jpeg is served instead of
+random bytes (needs Pillow).
+
+With --lookup-batch, the V&A scraper looks up the API fields of that many items with one request to the search
+of the API, which the server answers with the fixture of every object number in the query.
+
+Usage: python benchmarks/scrapers.py [-n ITEMS] [--latency MS] [--jitter MS] [--image-size KB]
+                                     [--concurrency N] [--min-concurrency N] [--max-concurrency N]
+                                     [--variant name=size[:format[:quality]] ...] [--lookup-batch N]
+                                     [vanda|wallace|hermitage ...]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from varscrap.images import ImageVariant  # noqa: E402
+from varscrap.scrapers.state_hermitage_museum import HermitageMuseum  # noqa: E402
+from varscrap.scrapers.v_and_a import VandA  # noqa: E402
+from varscrap.scrapers.wallace_collection import WallaceCollection  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as fi:
+        return fi.read()
+
+
+# (path pattern with the item id, fixture, id of the fixture, content type, cookie); None serves the image
+ROUTES = [
+    (re.compile(r"^/api/json/museumobject/O(?P<id>\d+)$"),
+     _fixture("vanda/O123456.json"), b"123456", "application/json", False),
+    (re.compile(r"^/media/thira/collection_images/\w{6}/\d{4}[A-Z]{2}(?P<id>\d+)\.jpg$"),
+     None, None, "image/jpeg", False),
+    (re.compile(r"^/eMuseumPlus\?service=ExternalInterface&.*objectId=(?P<id>\d+)"),
+     _fixture("wallace/detail_65155.html"), b"65155", "text/html", True),
+    (re.compile(r"^/eMuseumPlus\?service=ImageServlet&.*objectId=(?P<id>\d+)&.*isNoImage=F"),
+     _fixture("wallace/popup_65155.html"), b"65155", "text/html", True),
+    (re.compile(r"^/eMuseumPlus\?service=ImageServlet&.*objectId=(?P<id>\d+)"),
+     None, None, "image/jpeg", False),
+    (re.compile(r"^/wps/portal/hermitage/digital-collection/[^/]+/(?P<id>\d+)$"),
+     _fixture("hermitage/detail_1234567.html"), b"1234567", "text/html", True),
+    (re.compile(r"^/api/image/(?P<id>\d+)\.jpg$"),
+     None, None, "image/jpeg", False),
+]
+
+# the V&A search, answered with a record per object number in the query
+SEARCH = re.compile(r"^/api/json/museumobject/search\?")
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Serves the fixtures after latency + uniform(0, jitter) seconds and records when each item was first
+    requested and when its last response was finished.
+    """
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, latency: float, jitter: float, image_size: int):
+        super().__init__(('127.0.0.1', 0), ReplayHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.image = os.urandom(image_size)
+        self.lock = threading.Lock()
+        self.items = {}
+        self.requests = 0
+        self.errors = 0
+
+    def reset(self):
+        with self.lock:
+            self.items = {}
+            self.requests = 0
+            self.errors = 0
+
+    def record(self, item_ids, start, end):
+        with self.lock:
+            self.requests += 1
+            for item_id in item_ids:
+                first, last = self.items.get(item_id, (start, end))
+                self.items[item_id] = (min(first, start), max(last, end))
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start = time.perf_counter()
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+
+        if SEARCH.match(self.path):
+            self.__search(start)
+            return
+
+        for pattern, body, fixture_id, content_type, cookie in ROUTES:
+            match = pattern.match(self.path)
+            if match is not None:
+                break
+        else:
+            with self.server.lock:
+                self.server.errors += 1
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        item_id = match.group('id')
+        body = self.server.image if body is None else body.replace(fixture_id, item_id.encode('ascii'))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if cookie:
+            self.send_header("Set-Cookie", f"JSESSIONID={item_id}; Path=/")
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record([item_id], start, time.perf_counter())
+
+    def __search(self, start):
+        query = parse_qs(urlsplit(self.path).query)
+        item_ids = re.findall(r"O(\d+)", query.get('q', [""])[0])[:int(query.get('limit', ["45"])[0])]
+        fixture = ROUTES[0][1]
+        records = [json.loads(fixture.replace(b"123456", i.encode('ascii')))[0] for i in item_ids]
+        body = json.dumps({'meta': {'result_count': len(records)}, 'records': records}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(item_ids, start, time.perf_counter())
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Sends every request to the replay server instead of its host.
+    Responses keep the original url, so that their cookies are bound to the original host.
+    """
+
+    def __init__(self, address, **kwargs):
+        super().__init__(**kwargs)
+        self.__address = address
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.original_url = request.url
+        request.url = urlunsplit(('http', self.__address, url.path, url.query, ''))
+        return super().send(request, **kwargs)
+
+    def build_response(self, req, resp):
+        req.url = getattr(req, 'original_url', req.url)
+        return super().build_response(req, resp)
+
+
+class ReplayedHermitageMuseum(HermitageMuseum):
+    """
+    The search result urls are given instead of being harvested with selenium.
+    """
+
+    def __init__(self, links, **kwargs):
+        super().__init__(**kwargs)
+        self.__links = links
+
+    def _extract_all_from_search(self, search_url, browsers: int = 1):
+        return self.__links
+
+
+def _zotero_csv(file, urls):
+    with open(file, 'w', encoding='utf-8') as fo:
+        fo.write("Key,Url,Title,Manual Tags\n")
+        for i, url in enumerate(urls):
+            fo.write(f"K{i},{url},Item {i},tag{i % 3}\n")
+
+
+def _peak_rss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _jpeg():
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.effect_mandelbrot((2000, 1500), (-2, -1.2, 1, 1.2), 100).convert('RGB').save(buffer, 'jpeg', quality=90)
+    return buffer.getvalue()
+
+
+def run_scraper(name, address, items, options, variants, output, connection):
+    """
+    Runs one scraper in a fresh process and sends (seconds, peak rss in bytes) through connection.
+    """
+    ids = [str(100000 + i) for i in range(items)]
+    kwargs = dict(pool_size=max(options['concurrency'], options['max_concurrency']),
+                  image_variants=[ImageVariant.parse(v) for v in variants])
+    input_file = os.path.join(output, "input.csv")
+
+    if name == 'vanda':
+        _zotero_csv(input_file, [f"http://collections.vam.ac.uk/item/O{i}/view-of-the-thames" for i in ids])
+        scraper = VandA(**kwargs)
+    elif name == 'wallace':
+        _zotero_csv(input_file, [
+            f"http://wallacelive.wallacecollection.org/eMuseumPlus?service=ExternalInterface&module=collection"
+            f"&objectId={i}&viewType=detailView" for i in ids])
+        scraper = WallaceCollection(**kwargs)
+    else:
+        scraper = ReplayedHermitageMuseum([
+            f"https://www.hermitagemuseum.org/wps/portal/hermitage/digital-collection/01.+Paintings/{i}"
+            for i in ids], **kwargs)
+
+    adapter = ReplayAdapter(address, pool_connections=kwargs['pool_size'], pool_maxsize=kwargs['pool_size'])
+    scraper._session.mount("http://", adapter)
+    scraper._session.mount("https://", adapter)
+
+    start = time.perf_counter()
+    scraper.scrape(input_file=input_file, output=output, overwrite=False, **options)
+    scraper.close()
+    connection.send((time.perf_counter() - start, _peak_rss()))
+    connection.close()
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def benchmark(name, server, items, options, variants=()):
+    server.reset()
+    address = f"{server.server_address[0]}:{server.server_address[1]}"
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+
+    with tempfile.TemporaryDirectory() as output:
+        process = context.Process(target=run_scraper,
+                                  args=(name, address, items, options, list(variants), output, sender))
+        process.start()
+        sender.close()
+        seconds, peak_rss = receiver.recv()
+        process.join()
+
+    latencies = [last - first for first, last in server.items.values()]
+    return {
+        'items': len(latencies),
+        'requests': server.requests,
+        'not_found': server.errors,
+        'items_per_second': len(latencies) / seconds,
+        'p50': _percentile(latencies, 50) if latencies else float('nan'),
+        'p99': _percentile(latencies, 99) if latencies else float('nan'),
+        'peak_rss': peak_rss,
+    }
+
+
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("scrapers", nargs="*", help="vanda, wallace and/or hermitage (default: all)")
+    cli.add_argument("-n", "--items", type=int, default=200, help="Number of items per scraper")
+    cli.add_argument("--latency", type=float, default=50, help="Injected latency per request in ms")
+    cli.add_argument("--jitter", type=float, default=0, help="Additional random latency of up to this many ms")
+    cli.add_argument("--image-size", type=int, default=100, help="Size of the served images in KB")
+    cli.add_argument("--concurrency", type=int, default=1, help="--concurrency of V&A and Wallace")
+    cli.add_argument("--min-concurrency", type=int, default=1, help="--min-concurrency of the Hermitage")
+    cli.add_argument("--max-concurrency", type=int, default=10, help="--max-concurrency of the Hermitage")
+    cli.add_argument("--variant", dest="variants", action="append", default=[],
+                     help="Image variant the scrapers make, can be given several times")
+    cli.add_argument("--lookup-batch", type=int, default=1, help="--lookup-batch of V&A")
+    args = cli.parse_args()
+    args.scrapers = args.scrapers or ['vanda', 'wallace', 'hermitage']
+    for scraper_name in args.scrapers:
+        if scraper_name not in ('vanda', 'wallace', 'hermitage'):
+            cli.error(f"unknown scraper: {scraper_name}")
+
+    server = ReplayServer(args.latency / 1000, args.jitter / 1000, args.image_size * 1024)
+    if args.variants:
+        server.image = _jpeg()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    scrape_options = dict(concurrency=args.concurrency,
+                          min_concurrency=args.min_concurrency,
+                          max_concurrency=args.max_concurrency,
+                          lookup_batch=args.lookup_batch)
+
+    print(f"{args.items} items, latency {args.latency:g}+{args.jitter:g} ms, images of {args.image_size} KB, "
+          f"concurrency {args.concurrency}, hermitage {args.min_concurrency}-{args.max_concurrency}"
+          + (f", lookup batch {args.lookup_batch}" if args.lookup_batch > 1 else "")
+          + (f", variants {' '.join(args.variants)}" if args.variants else ""))
+    print(f"{'scraper':<10} {'items':>6} {'requests':>8} {'items/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'rss MB':>8}")
+    for scraper_name in args.scrapers:
+        result = benchmark(scraper_name, server, args.items, scrape_options, args.variants)
+        print(f"{scraper_name:<10} {result['items']:>6} {result['requests']:>8} {result['items_per_second']:>8.1f} "
+              f"{result['p50'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f} {result['peak_rss'] / 1024 ** 2:>8.1f}")
+        if result['not_found']:
+            print(f"  {result['not_found']} requests did not match a fixture")
+    server.shutdown()
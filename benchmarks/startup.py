@@ -0,0 +1,93 @@
+"""
+Startup time benchmark: how long importing the package and its scrapers takes in a fresh interpreter,
+and which heavy dependencies they load.
+
+Every import is timed in a new process, as the modules are cached after the first import. The heavy
+dependencies are only to be imported when the code that needs them runs: requests when the first request is
+sent, selenium when the Hermitage search is harvested, pyarrow when Parquet is written. If an import loads
+one of the dependencies it must not load, or is slower than --max-ms, the benchmark exits with 1, so it can
+guard against regressions.
+
+Usage: python benchmarks/startup.py [-r REPEAT] [--max-ms MS]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+HEAVY = ('requests', 'urllib3', 'selenium', 'lxml', 'pandas', 'numpy', 'pyarrow', 'http.server')
+
+# (name, statement, heavy modules it may load)
+IMPORTS = [
+    ('varscrap', "import varscrap", ()),
+    ('cli --help', None, ()),
+    ('v_and_a', "import varscrap.scrapers.v_and_a", ()),
+    ('wallace', "import varscrap.scrapers.wallace_collection", ('lxml',)),
+    ('hermitage', "import varscrap.scrapers.state_hermitage_museum", ('lxml',)),
+]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+_CLI_PROBE = """
+import json, runpy, sys, time
+sys.argv = ['varscrap_cli.py', '--help']
+start = time.perf_counter()
+try:
+    runpy.run_path('varscrap_cli.py', run_name='__main__')
+except SystemExit:
+    pass
+seconds = time.perf_counter() - start
+sys.stdout = sys.__stdout__
+print(json.dumps([seconds, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+
+def measure(statement):
+    """
+    :return: (seconds, heavy modules loaded) of one import in a fresh interpreter
+    """
+    if statement is None:
+        code = _CLI_PROBE.format(heavy=HEAVY)
+    else:
+        code = _PROBE.format(statement=statement, heavy=HEAVY)
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    seconds, loaded = json.loads(output.strip().splitlines()[-1])
+    return seconds, loaded
+
+
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("-r", "--repeat", type=int, default=5, help="Number of processes per import")
+    cli.add_argument("--max-ms", type=float, default=None, help="Fail if an import takes longer (median)")
+    args = cli.parse_args()
+
+    failed = False
+    print(f"{'import':<12} {'median ms':>10} {'min ms':>8}  heavy modules")
+    for name, statement, allowed in IMPORTS:
+        times = []
+        loaded = []
+        for _ in range(args.repeat):
+            seconds, loaded = measure(statement)
+            times.append(seconds * 1000)
+        median = statistics.median(times)
+        print(f"{name:<12} {median:>10.1f} {min(times):>8.1f}  {', '.join(loaded) or '-'}")
+
+        unexpected = [m for m in loaded if m not in allowed]
+        if unexpected:
+            print(f"  {name} must not import {', '.join(unexpected)}")
+            failed = True
+        if args.max_ms is not None and median > args.max_ms:
+            print(f"  {name} takes longer than {args.max_ms:g} ms")
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the field extraction of WallaceCollection on saved detail pages.
+
+Every page is parsed once, the legacy and the compiled extraction are timed on the same trees;
+the time to parse a page is reported on its own.
+
+Usage: python benchmarks/wallace_extract.py [-n ITERATIONS] [PAGE.html ...]
+Without pages, the fixtures in benchmarks/fixtures/wallace are used.
+"""
+import argparse
+import glob
+import os
+import sys
+import timeit
+
+from lxml import html
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from varscrap.scrapers.wallace_collection import WallaceCollection  # noqa: E402
+
+# the absolute paths that were evaluated from the document root for every field before
+LEGACY_XPATH = {
+    'object_name': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[1]/span[1]/text()',
+    'title': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[2]/span[1]/text()',
+    'reference': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[3]/span/span/a/span/text()',
+    'reference_data': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[4]/span[1]/text()',
+    'place_artist': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[5]/span[1]/text()',
+    'dates_all': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[6]/span[1]/text()',
+    'material': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[7]/span[1]/text()',
+    'dimensions': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[8]/span[1]/text()',
+    'marks': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[9]/span[1]/text()',
+    'museum_number': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[10]/span[1]/text()',
+    'commentary': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[2]/dd/div/ul/li/span[1]/text()',
+    'image_url': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dt[1]/a/@href'
+}
+
+
+def legacy_extract(html_page):
+    values = {}
+    for xpath_key, xpath_string in LEGACY_XPATH.items():
+        xpath = html_page.xpath(xpath_string)
+        values[xpath_key] = xpath[0] if len(xpath) > 0 else ""
+    return values
+
+
+def measure(func, pages, iterations):
+    seconds = min(timeit.repeat(lambda: [func(p) for p in pages], number=iterations, repeat=3))
+    return seconds / (iterations * len(pages)) * 1e6
+
+
+if __name__ == '__main__':
+    cli = argparse.ArgumentParser()
+    cli.add_argument("pages", nargs="*", help="Saved detail pages")
+    cli.add_argument("-n", "--iterations", type=int, default=200)
+    args = cli.parse_args()
+
+    files = args.pages or sorted(
+        glob.glob(os.path.join(os.path.dirname(__file__), "fixtures", "wallace", "detail_*.html")))
+    pages = []
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as fi:
+            pages.append(fi.read())
+
+    trees = [html.fromstring(page) for page in pages]
+    for tree in trees:
+        if legacy_extract(tree) != WallaceCollection._extract_fields(tree):
+            raise AssertionError("The extraction differs from the legacy extraction")
+
+    parse = measure(html.fromstring, pages, args.iterations)
+    legacy = measure(legacy_extract, trees, args.iterations)
+    compiled = measure(WallaceCollection._extract_fields, trees, args.iterations)
+
+    print(f"{len(pages)} pages, {args.iterations} iterations, microseconds per page:")
+    print(f"  parse:              {parse:8.1f}")
+    print(f"  legacy extract:     {legacy:8.1f}")
+    print(f"  compiled extract:   {compiled:8.1f}  ({legacy / compiled:.1f}x faster)")
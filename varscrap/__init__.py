@@ -1 +1,3 @@
 from .main import run
+from .distributed import merge
+from .jobs import run_jobs
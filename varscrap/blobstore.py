@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+_log = logging.getLogger(__name__)
+
+
+class BlobStore(object):
+    """
+    A content-addressed store for downloaded images that can be shared by several output folders and runs.
+
+    Every image is stored once as "blobs/<h[:2]>/<h>.<ext>", named by the sha256 h of its content, and the
+    per-item files in the output folders are hard links to it (copies if linking is not possible).
+    "urls.log" remembers which url resolved to which blob, so a known url is never downloaded again.
+    """
+
+    # a lock file of a partial download that is older is left by a process that died
+    _STALE_LOCK_SECONDS = 3600
+
+    def __init__(self, directory: str):
+        self.__directory = directory
+        self.__lock = Lock()
+        # the same url must not be downloaded by two threads at once, other processes are kept out of its
+        # partial file by a lock file
+        self.__url_locks = [Lock() for _ in range(64)]
+        self.__urls: Dict[str, str] = {}
+
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "partial"), exist_ok=True)
+
+        url_log = os.path.join(directory, "urls.log")
+        if os.path.isfile(url_log):
+            with open(url_log, 'r') as fi:
+                for line in fi:
+                    if line.endswith("\n"):
+                        blob, _, url = line.rstrip("\n").partition("\t")
+                        self.__urls[url] = blob
+        self.__url_log = open(url_log, 'a')
+
+    def __len__(self):
+        return len(self.__urls)
+
+    def lookup(self, url: str) -> Optional[str]:
+        """
+        :return: path of the blob the url resolved to or None if it is unknown
+        """
+        blob = self.__urls.get(url)
+        if blob is not None:
+            path = os.path.join(self.__directory, "blobs", blob)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def fetch(self, url: str, target_file: str, download: Callable[[str], bool]) -> bool:
+        """
+        Makes target_file a link to the blob of url, downloading it only if the url is not known yet.
+
+        :param url: url of the image
+        :param target_file: the per-item file in the output folder
+        :param download: function that downloads url into the given file and returns whether it succeeded
+        :return: whether target_file exists afterwards
+        """
+        url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        with self.__url_locks[int(url_hash[:8], 16) % len(self.__url_locks)]:
+            path = self.lookup(url)
+            if path is None:
+                _, ext = os.path.splitext(target_file)
+                with self.__partial_file(url_hash, ext) as partial:
+                    if not download(partial):
+                        return False
+                    path = self.__add(url, partial, ext)
+            else:
+                _log.debug("Image already in blob store: %s", url)
+
+        self.__link(path, target_file)
+        return True
+
+    @contextmanager
+    def __partial_file(self, url_hash: str, ext: str):
+        """
+        The file a url is downloaded into. The store may be shared by several processes, e.g. the workers of a run
+        on a shared file system: the process that creates the lock file of the url downloads into its partial file,
+        which an interrupted download is continued from; a process that finds it locked downloads into a file of
+        its own rather than waiting, the blob of the content is the same.
+        """
+        partial = os.path.join(self.__directory, "partial", url_hash + ext)
+        lock = partial + ".lock"
+        locked = self.__create_lock(lock)
+        if not locked:
+            _log.debug("Partial file is locked by another process: %s", partial)
+            partial = os.path.join(self.__directory, "partial", f"{url_hash}.{uuid.uuid4().hex}{ext}")
+        try:
+            yield partial
+        finally:
+            if locked:
+                os.remove(lock)
+            else:
+                for file in (partial, partial + ".part"):
+                    if os.path.isfile(file):
+                        os.remove(file)
+
+    def __create_lock(self, lock: str) -> bool:
+        """
+        :return: whether the lock file was created, False if another process holds it
+        """
+        for _ in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(lock)
+                except OSError:
+                    continue
+                if age < self._STALE_LOCK_SECONDS:
+                    return False
+                _log.warning("Removing stale lock file: %s", lock)
+                try:
+                    os.remove(lock)
+                except OSError:
+                    pass
+        return False
+
+    def __add(self, url: str, file: str, ext: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(file, 'rb') as fi:
+            for chunk in iter(lambda: fi.read(1024 ** 2), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        blob = f"{digest[:2]}/{digest}{ext}"
+        path = os.path.join(self.__directory, "blobs", blob)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.isfile(path):
+            _log.debug("Same content already in blob store: %s", url)
+            os.remove(file)
+        else:
+            os.replace(file, path)
+
+        with self.__lock:
+            self.__urls[url] = blob
+            self.__url_log.write(f"{blob}\t{url}\n")
+            self.__url_log.flush()
+        return path
+
+    @staticmethod
+    def __link(path: str, target_file: str):
+        if os.path.isfile(target_file):
+            os.remove(target_file)
+        try:
+            os.link(path, target_file)
+        except OSError:
+            shutil.copyfile(path, target_file)
+
+    def close(self):
+        with self.__lock:
+            self.__url_log.close()
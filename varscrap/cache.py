@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+_log = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    """
+    A persistent cache of HTTP responses, keyed by URL.
+
+    Only responses with an ETag or Last-Modified header are stored. Cached responses are always revalidated
+    with If-None-Match / If-Modified-Since, so the server only has to answer with 304 Not Modified.
+    Every entry is a "<key>.json" file with the headers next to a "<key>.body" file with the content.
+    The least recently used entries are evicted when the bodies exceed max_size bytes.
+    """
+
+    def __init__(self, directory: str, max_size: int = 1024 ** 3):
+        self.__directory = directory
+        self.__max_size = max_size
+        self.__lock = Lock()
+        self.__entries: Dict[str, int] = OrderedDict()
+        self.__size = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".body"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(".body")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.__entries[key] = size
+            self.__size += size
+
+        _log.debug("Opened response cache '%s' with %s entries (%s bytes)", directory, len(entries), self.__size)
+
+    @property
+    def size(self):
+        return self.__size
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def __path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.__directory, key + suffix)
+
+    def lookup(self, url: str) -> Optional[Dict]:
+        """
+        :param url: the requested url
+        :return: the stored metadata of the url or None if it is not cached
+        """
+        key = self._key(url)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+        try:
+            with open(self.__path(key, ".json"), 'r') as fi:
+                return json.load(fi)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def conditional_headers(meta: Dict) -> Dict[str, str]:
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def revive(self, response: requests.Response, meta: Dict) -> Optional[requests.Response]:
+        """
+        Turns a 304 Not Modified response into the cached 200 response.
+        Headers and cookies of the 304 response are kept, so that follow-up requests can still use them.
+
+        :param response: the 304 response of the revalidation
+        :param meta: the metadata returned by lookup
+        :return: the response with the cached status, headers and content or None if the entry is gone
+        """
+        key = self._key(meta['url'])
+        try:
+            with open(self.__path(key, ".body"), 'rb') as fi:
+                content = fi.read()
+        except OSError:
+            return None
+        self.__touch(key)
+
+        headers = dict(meta['headers'])
+        headers.update(response.headers)
+        response.headers = CaseInsensitiveDict(headers)
+        response.status_code = 200
+        response.reason = "OK"
+        response.encoding = meta.get('encoding')
+        response._content = content
+        return response
+
+    def store(self, url: str, response: requests.Response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+
+        key = self._key(url)
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'encoding': response.encoding,
+            'headers': {k: v for k, v in response.headers.items()
+                        if k.lower() not in ('set-cookie', 'content-length', 'content-encoding',
+                                             'transfer-encoding', 'connection')}
+        }
+        content = response.content
+
+        self.__write(self.__path(key, ".body"), content)
+        self.__write(self.__path(key, ".json"), json.dumps(meta).encode('utf-8'))
+
+        with self.__lock:
+            self.__size += len(content) - self.__entries.pop(key, 0)
+            self.__entries[key] = len(content)
+            self.__evict()
+
+    def __write(self, path: str, data: bytes):
+        with NamedTemporaryFile(dir=self.__directory, suffix=".tmp", delete=False) as fo:
+            fo.write(data)
+        os.replace(fo.name, path)
+
+    def __touch(self, key: str):
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+        try:
+            os.utime(self.__path(key, ".body"))
+        except OSError:
+            pass
+
+    def __evict(self):
+        while self.__size > self.__max_size and len(self.__entries) > 1:
+            key, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            for suffix in (".json", ".body"):
+                try:
+                    os.remove(self.__path(key, suffix))
+                except OSError:
+                    pass
+            _log.debug("Evicted '%s' from the response cache", key)
@@ -0,0 +1,160 @@
+import logging
+from contextlib import contextmanager
+from threading import Condition
+from typing import Dict, Optional
+
+_log = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the number of items in flight and adapts the limit to how the server copes with it
+    (additive increase, multiplicative decrease).
+
+    Every successful request counts towards an increase by one after "limit" successes in a row, as long as the
+    average latency stays below latency_factor times the best average seen so far. Throttling (429), server
+    errors (5xx) and connection errors halve the limit, at most once per "limit" finished requests, so that a
+    burst of failures of requests that were already in flight only counts once.
+
+    Use it as a context manager around the work of one item; the current limit is exposed as limit.
+    """
+
+    def __init__(self, min_limit: int = 1, max_limit: int = 10, initial: int = None, latency_factor: float = 2.0):
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError(f"Invalid concurrency bounds: {min_limit}-{max_limit}")
+        self.__min_limit = min_limit
+        self.__max_limit = max_limit
+        self.__limit = min(max(initial or min_limit, min_limit), max_limit)
+        self.__latency_factor = latency_factor
+        self.__in_flight = 0
+        self.__successes = 0
+        self.__since_decrease = 0
+        self.__latency = None
+        self.__best_latency = None
+        self.__condition = Condition()
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
+    @property
+    def in_flight(self) -> int:
+        return self.__in_flight
+
+    @property
+    def max_limit(self) -> int:
+        return self.__max_limit
+
+    def acquire(self):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__in_flight < self.__limit)
+            self.__in_flight += 1
+
+    def release(self):
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def record(self, latency: float, status_code: int = None):
+        """
+        Records the outcome of one request.
+
+        :param latency: seconds the request took
+        :param status_code: HTTP status of the response or None if there was no response (timeout, connection error)
+        """
+        with self.__condition:
+            self.__since_decrease += 1
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self.__successes = 0
+                if self.__since_decrease >= self.__limit and self.__limit > self.__min_limit:
+                    _log.debug("Concurrency %s -> %s (status: %s)",
+                               self.__limit, max(self.__min_limit, self.__limit // 2), status_code)
+                    self.__set_limit(max(self.__min_limit, self.__limit // 2))
+                    self.__since_decrease = 0
+                return
+
+            self.__latency = latency if self.__latency is None else 0.8 * self.__latency + 0.2 * latency
+            if self.__best_latency is None or self.__latency < self.__best_latency:
+                self.__best_latency = self.__latency
+
+            self.__successes += 1
+            if self.__successes >= self.__limit and self.__limit < self.__max_limit:
+                self.__successes = 0
+                if self.__latency <= self.__latency_factor * self.__best_latency:
+                    _log.debug("Concurrency %s -> %s (latency: %.2fs)", self.__limit, self.__limit + 1, self.__latency)
+                    self.__set_limit(self.__limit + 1)
+
+    def __set_limit(self, limit: int):
+        self.__limit = limit
+        self.__condition.notify_all()
+
+
+class HostScheduler(object):
+    """
+    Shares the requests of several scrapers that run in the same process: at most max_requests requests are in
+    flight in total, and to every host at most its budget in host_limits (default_host_limit for hosts without one),
+    so that a slow site never holds the slots the others could use.
+
+    Use slot(host) as a context manager around one request.
+    """
+
+    def __init__(self, max_requests: int = 16, host_limits: Optional[Dict[str, int]] = None,
+                 default_host_limit: Optional[int] = None):
+        host_limits = dict(host_limits or {})
+        if max_requests < 1 or any(limit < 1 for limit in host_limits.values()) or \
+                (default_host_limit is not None and default_host_limit < 1):
+            raise ValueError(f"Invalid request budgets: {max_requests} in total, {host_limits} per host")
+        self.__max_requests = max_requests
+        self.__host_limits = host_limits
+        self.__default_host_limit = default_host_limit or max_requests
+        self.__in_flight = 0
+        self.__host_in_flight: Dict[str, int] = {}
+        self.__condition = Condition()
+
+    @property
+    def max_requests(self) -> int:
+        return self.__max_requests
+
+    @property
+    def in_flight(self) -> int:
+        return self.__in_flight
+
+    def limit(self, host: str) -> int:
+        """
+        :return: the number of requests to host that may be in flight at the same time
+        """
+        return self.__host_limits.get(host, self.__default_host_limit)
+
+    def host_in_flight(self, host: str) -> int:
+        return self.__host_in_flight.get(host, 0)
+
+    def acquire(self, host: str):
+        limit = self.limit(host)
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__in_flight < self.__max_requests and
+                                      self.__host_in_flight.get(host, 0) < limit)
+            self.__in_flight += 1
+            self.__host_in_flight[host] = self.__host_in_flight.get(host, 0) + 1
+
+    def release(self, host: str):
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__host_in_flight[host] -= 1
+            if self.__host_in_flight[host] == 0:
+                del self.__host_in_flight[host]
+            self.__condition.notify_all()
+
+    @contextmanager
+    def slot(self, host: str):
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
@@ -1,11 +1,24 @@
+import csv
+import hashlib
+import json
+import logging
 import re
+import sys
+from typing import Iterable, Iterator, List, Pattern, Union
+
+_log = logging.getLogger(__name__)
 
 
 class ZoteroData(object):
-    def __init__(self, object_id: str, title: str, tag: str):
+    __slots__ = ('__object_id', '__title', '__tag', '__key', '__url', '__digest')
+
+    def __init__(self, object_id: str, title: str, tag: str, key: str = "", url: str = "", digest: bytes = b""):
         self.__object_id = object_id
         self.__title = title
         self.__tag = tag
+        self.__key = key
+        self.__url = url
+        self.__digest = digest
 
     @property
     def object_id(self):
@@ -19,17 +32,80 @@ class ZoteroData(object):
     def tag(self):
         return self.__tag
 
+    @property
+    def key(self):
+        """
+        The Zotero key of the row, or its url if the export has no keys
+        """
+        return self.__key
+
+    @property
+    def url(self):
+        return self.__url
+
+    @property
+    def digest(self):
+        """
+        A 16 byte hash over all columns of the row, it changes whenever anything in the row changes
+        """
+        return self.__digest
+
+
+def read_csv(csv_file: str, pattern: Union[str, Pattern], chunk_size: int = 1000,
+             ignored_tags: Iterable[str] = ()) -> Iterator[List[ZoteroData]]:
+    """
+    Streams a csv file as exported by Zotero without loading it as a whole.
+
+    :param csv_file: the exported csv file
+    :param pattern: pattern with an "objectId" group that finds the object id in the url
+    :param chunk_size: number of records per yielded chunk
+    :param ignored_tags: rows whose tag contains one of these are skipped
+    :return: chunks of records in the order of the file, every object id only once
+    """
+    pattern = re.compile(pattern)
+    ignored_tags = tuple(ignored_tags)
+    seen = set()
+    chunk = []
+
+    with open(csv_file, 'r', newline='', encoding='utf-8-sig') as fi:
+        for row in csv.DictReader(fi, restval=''):
+            data = parse_row(row, pattern)
+            if any(x in data.tag for x in ignored_tags):
+                continue
+            if data.object_id in seen:
+                _log.debug("Duplicated object id: '%s'", data.object_id)
+                continue
+            seen.add(data.object_id)
+
+            chunk.append(data)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
 
 def parse_row(row, pattern) -> ZoteroData:
+    # object ids are shared with the journal and the manifest, and there are few distinct tags, so both are interned
     return ZoteroData(
-        object_id=_extract_item_id(row['Url'], pattern),
+        object_id=sys.intern(_extract_item_id(row['Url'], pattern)),
         title=row['Title'],
-        tag=row['Manual Tags']
+        tag=sys.intern(row['Manual Tags']),
+        key=row.get('Key') or row['Url'],
+        url=row['Url'],
+        digest=_digest(row)
     )
 
 
-def _extract_item_id(url: str, pattern: str):
-    matches = re.search(pattern, url)
+def _digest(row) -> bytes:
+    # columns beyond the header end up in a list under the key None
+    text = json.dumps(list(row.items()), ensure_ascii=False)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def _extract_item_id(url: str, pattern: Union[str, Pattern]):
+    matches = re.compile(pattern).search(url)
     if matches:
         return matches.groupdict()["objectId"]
     else:
@@ -0,0 +1,218 @@
+import csv
+import json
+import logging
+import os
+import sys
+from tempfile import NamedTemporaryFile
+from typing import Container, Dict, Iterable, List, Set, Tuple
+
+from .converters.zotero import ZoteroData
+
+_log = logging.getLogger(__name__)
+
+
+class Delta(object):
+    """
+    What changed in a Zotero export since its manifest was written, by object id.
+    Objects whose row changed in other columns than the tags count as unchanged, there is nothing to do for them.
+    Only the objects that still have to be scraped are kept, of all others only the tag.
+    """
+    __slots__ = ('__tags', '__pending', '__added', '__retagged', '__removed', '__unchanged')
+
+    def __init__(self, tags: Dict[str, str], pending: List[ZoteroData], added: int, retagged: Dict[str, str],
+                 removed: List[str], unchanged: int):
+        self.__tags = tags
+        self.__pending = pending
+        self.__added = added
+        self.__retagged = retagged
+        self.__removed = removed
+        self.__unchanged = unchanged
+
+    @property
+    def tags(self):
+        """
+        The tag of every object of the current export by object id
+        """
+        return self.__tags
+
+    @property
+    def pending(self):
+        """
+        The objects that were not scraped yet, in the order of the export
+        """
+        return self.__pending
+
+    @property
+    def added(self):
+        return self.__added
+
+    @property
+    def retagged(self):
+        """
+        The new tag of the objects whose tags changed by object id
+        """
+        return self.__retagged
+
+    @property
+    def removed(self):
+        return self.__removed
+
+    @property
+    def unchanged(self):
+        return self.__unchanged
+
+    def __str__(self):
+        return (f"{self.added} added, {len(self.retagged)} with changed tags, {len(self.removed)} removed, "
+                f"{self.unchanged} unchanged")
+
+
+class Manifest(object):
+    """
+    The rows of the Zotero export that the last delta run of an output folder processed,
+    one json line per object: {"object_id": ..., "key": ..., "url": ..., "tags": ..., "hash": ...},
+    where hash changes whenever anything in the row changes.
+
+    Of every object only its tags and hash are kept in memory. The manifest of the current export is written
+    to "<manifest>.new" while it is compared and only replaces the manifest on commit, once the run is finished,
+    so an interrupted run computes the same delta again.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__entries: Dict[str, Tuple[str, bytes]] = {}
+
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as fi:
+                for line in fi:
+                    if line.endswith("\n"):
+                        entry = json.loads(line)
+                        self.__entries[sys.intern(entry['object_id'])] = (sys.intern(entry['tags']),
+                                                                          bytes.fromhex(entry['hash']))
+            _log.info("Read manifest '%s' with %s objects", path, len(self.__entries))
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def diff(self, objects: Iterable[ZoteroData], done: Container[str]) -> Delta:
+        """
+        Compares the objects of the current export with the manifest, in one pass over them.
+
+        :param objects: the objects of the current export, e.g. as they are read
+        :param done: ids of the objects that were scraped already, all others are pending
+        """
+        tags = {}
+        pending = []
+        added = 0
+        retagged = {}
+        unchanged = 0
+        with open(self.__path + ".new", 'w', encoding='utf-8') as fo:
+            for obj in objects:
+                tags[obj.object_id] = obj.tag
+                entry = self.__entries.get(obj.object_id)
+                if entry is None:
+                    added += 1
+                elif entry[1] != obj.digest and entry[0] != obj.tag:
+                    retagged[obj.object_id] = obj.tag
+                else:
+                    unchanged += 1
+                if obj.object_id not in done:
+                    pending.append(obj)
+                fo.write(json.dumps({'object_id': obj.object_id, 'key': obj.key, 'url': obj.url, 'tags': obj.tag,
+                                     'hash': obj.digest.hex()}, ensure_ascii=False) + "\n")
+        removed = [object_id for object_id in self.__entries if object_id not in tags]
+        return Delta(tags, pending, added, retagged, removed, unchanged)
+
+    def commit(self):
+        """
+        Replaces the manifest with the one of the export of the last diff.
+        """
+        os.replace(self.__path + ".new", self.__path)
+
+
+def annotated_objects(annotation_file: str, id_column: str) -> Set[str]:
+    """
+    :return: the ids of the objects that have rows in an annotation csv, which may not exist yet
+    """
+    if not os.path.isfile(annotation_file):
+        return set()
+    with open(annotation_file, 'r', newline='', encoding='utf-8') as fi:
+        reader = csv.reader(fi)
+        header = next(reader, None)
+        if header is None:
+            return set()
+        id_index = header.index(id_column)
+        return {sys.intern(row[id_index]) for row in reader}
+
+
+def patch_annotations(annotation_file: str, id_column: str, tags: Dict[str, str], renumber: bool = False) -> int:
+    """
+    Brings an annotation csv up to date with the export: rows of objects that are not in tags are dropped,
+    the others get the tag in tags. The rows are streamed to a new file, which only replaces the annotation csv
+    if a row changed.
+
+    :param annotation_file: the annotation csv of a scraper, may not exist yet
+    :param id_column: the column with the object id
+    :param tags: the current tag of every object of the export
+    :param renumber: whether the first column is the row number, which has to be renumbered
+    :return: the number of rows
+    """
+    if not os.path.isfile(annotation_file):
+        return 0
+
+    rows = 0
+    changed = False
+    with open(annotation_file, 'r', newline='', encoding='utf-8') as fi, \
+            NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(annotation_file)), suffix=".tmp",
+                               newline='', encoding='utf-8', delete=False) as fo:
+        reader = csv.reader(fi)
+        writer = csv.writer(fo, lineterminator='\n')
+        header = next(reader, None)
+        if header is not None:
+            writer.writerow(header)
+            id_index = header.index(id_column)
+            tag_index = header.index('tag')
+            for row in reader:
+                tag = tags.get(row[id_index])
+                if tag is None:
+                    changed = True
+                    continue
+                if row[tag_index] != tag:
+                    row[tag_index] = tag
+                    changed = True
+                if renumber and row[0] != str(rows):
+                    row[0] = str(rows)
+                    changed = True
+                writer.writerow(row)
+                rows += 1
+
+    if changed:
+        os.replace(fo.name, annotation_file)
+        _log.info("Patched '%s', %s rows left", annotation_file, rows)
+    else:
+        os.remove(fo.name)
+    return rows
+
+
+def patch_records(output: str, tags: Dict[str, str]) -> int:
+    """
+    Sets the tag in the "<object_id>.json" records of the given objects.
+
+    :return: the number of records that were patched
+    """
+    patched = 0
+    for object_id, tag in tags.items():
+        json_file = os.path.join(output, f"{object_id}.json")
+        if not os.path.isfile(json_file):
+            continue
+        with open(json_file, 'r') as fi:
+            record = json.load(fi)
+        record['tag'] = tag
+        with NamedTemporaryFile('w', dir=output, suffix=".tmp", delete=False) as fo:
+            json.dump(record, fo, indent=2)
+        os.replace(fo.name, json_file)
+        patched += 1
+    return patched
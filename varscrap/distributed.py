@@ -0,0 +1,99 @@
+import csv
+import glob
+import logging
+import os
+import re
+from typing import Optional, Tuple, Union
+
+_log = logging.getLogger(__name__)
+
+# annotation csv files of the scrapers and the columns with the item id and the image path
+ANNOTATION_FILES = {
+    'vanda_scraped.csv': ('item_id', 'image_path'),
+    'wallace_annotation.csv': ('object_id', 'image_name'),
+    'hermitage_museum_annotation.csv': ('object_id', 'image_name'),
+}
+
+_SHARD_PATTERN = re.compile(r"^(\d+)/(\d+)$")
+
+
+def parse_shard(shard: Union[str, Tuple[int, int], None]) -> Optional[Tuple[int, int]]:
+    """
+    :param shard: "i/N" or (i, N): this worker is worker i (counted from 0) of N
+    :return: (i, N) or None if shard is None
+    """
+    if shard is None:
+        return None
+    if isinstance(shard, str):
+        match = _SHARD_PATTERN.match(shard.strip())
+        if match is None:
+            raise ValueError(f"A shard has to be given as i/N: '{shard}'")
+        shard = int(match.group(1)), int(match.group(2))
+    index, count = shard
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {index}/{count}, i has to be between 0 and N - 1")
+    return index, count
+
+
+def shard_folder(output_folder: str, shard: Tuple[int, int]) -> str:
+    """
+    :return: the folder a worker writes all its outputs to, so that workers never write the same file
+    """
+    return os.path.join(output_folder, f"shard-{shard[0]}-of-{shard[1]}")
+
+
+def merge(output_folder: str):
+    """
+    Combines the annotation csv files and dead letter files of all worker folders ("shard-i-of-N")
+    of an output folder into one file each in the output folder.
+    Image file names are made relative to the output folder, items are sorted by id.
+    """
+    folders = sorted(glob.glob(os.path.join(output_folder, "shard-*-of-*")))
+    if not folders:
+        raise ValueError(f"No worker folders found in '{output_folder}'")
+    _log.info("Merging %s worker folders", len(folders))
+
+    for name, (id_column, image_column) in ANNOTATION_FILES.items():
+        rows = []
+        header = None
+        for folder in folders:
+            file = os.path.join(folder, name)
+            if not os.path.isfile(file):
+                continue
+            with open(file, 'r', newline='', encoding='utf-8') as fi:
+                reader = csv.reader(fi)
+                file_header = next(reader, None)
+                if file_header is None:
+                    continue
+                header = file_header
+                # the image and its variants ("<image column>_<variant>")
+                image_indices = [i for i, column in enumerate(header)
+                                 if column == image_column or column.startswith(image_column + "_")]
+                for row in reader:
+                    # bare file names are relative to the worker folder, paths are kept as they are
+                    for image_index in image_indices:
+                        if row[image_index] and not os.path.dirname(row[image_index]):
+                            row[image_index] = os.path.join(os.path.basename(folder), row[image_index])
+                    rows.append(row)
+        if header is None:
+            continue
+
+        id_index = header.index(id_column)
+        rows.sort(key=lambda r: r[id_index])
+        with open(os.path.join(output_folder, name), 'w', newline='', encoding='utf-8') as fo:
+            writer = csv.writer(fo, lineterminator='\n')
+            writer.writerow(header)
+            for i, row in enumerate(rows):
+                # the V&A file is indexed by row number, the others by object id
+                if id_column == 'item_id':
+                    row[0] = str(i)
+                writer.writerow(row)
+        _log.info("Merged %s rows into '%s'", len(rows), name)
+
+    dead_letters = [os.path.join(f, "dead_letter.jsonl") for f in folders
+                    if os.path.isfile(os.path.join(f, "dead_letter.jsonl"))]
+    if dead_letters:
+        with open(os.path.join(output_folder, "dead_letter.jsonl"), 'w', encoding='utf-8') as fo:
+            for file in dead_letters:
+                with open(file, 'r', encoding='utf-8') as fi:
+                    fo.writelines(line for line in fi if line.endswith("\n"))
@@ -0,0 +1,135 @@
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+_log = logging.getLogger(__name__)
+
+
+class ImageVariant(object):
+    """
+    A derived version of every downloaded image, written next to it as "<image>.<name>.<extension>",
+    e.g. "O123_0.thumb.jpg": scaled down so that its longer side is at most size pixels
+    (only re-encoded if size is None) and saved in the given format.
+    """
+
+    __EXTENSIONS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp'}
+    __PATTERN = re.compile(r"^(?P<name>[A-Za-z][A-Za-z0-9_-]*)=(?P<size>\d+|orig)"
+                           r"(?::(?P<format>jpeg|png|webp))?(?::(?P<quality>\d+))?$")
+
+    def __init__(self, name: str, size: Optional[int] = None, format: str = 'jpeg', quality: int = 85):
+        if format not in self.__EXTENSIONS:
+            raise ValueError(f"Unsupported image format: '{format}'")
+        self.__name = name
+        self.__size = size
+        self.__format = format
+        self.__quality = quality
+
+    @classmethod
+    def parse(cls, text: str) -> 'ImageVariant':
+        """
+        :param text: "name=size[:format[:quality]]", e.g. "train=1024", "thumb=128:webp:80" or "png=orig:png"
+        """
+        match = cls.__PATTERN.match(text.strip())
+        if match is None:
+            raise ValueError(f"An image variant has to be given as name=size[:format[:quality]]: '{text}'")
+        size = match.group('size')
+        return cls(name=match.group('name'),
+                   size=None if size == 'orig' else int(size),
+                   format=match.group('format') or 'jpeg',
+                   quality=int(match.group('quality') or 85))
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def format(self):
+        return self.__format
+
+    @property
+    def quality(self):
+        return self.__quality
+
+    @property
+    def suffix(self):
+        return f".{self.__name}.{self.__EXTENSIONS[self.__format]}"
+
+    def file(self, image_file: str) -> str:
+        """
+        :return: the file of this variant of image_file
+        """
+        return os.path.splitext(image_file)[0] + self.suffix
+
+    def __repr__(self):
+        return f"ImageVariant({self.__name}={self.__size or 'orig'}:{self.__format}:{self.__quality})"
+
+
+def make_variants(image_file: str, variants: Sequence[ImageVariant]) -> Tuple[Dict[str, str], float]:
+    """
+    Writes the variants of an image that do not exist yet. Runs in the worker processes of the ImageProcessor.
+
+    :return: the files of the variants by their name and the seconds it took
+    """
+    from PIL import Image
+
+    start = time.monotonic()
+    files = {v.name: v.file(image_file) for v in variants}
+    missing = [v for v in variants if not os.path.isfile(files[v.name])]
+    if missing:
+        with Image.open(image_file) as image:
+            # the jpeg decoder can scale by 1/2, 1/4 or 1/8 while decoding, which is much faster than decoding
+            # the full image, as long as the result is not smaller than the biggest variant
+            if all(v.size is not None for v in missing):
+                biggest = max(v.size for v in missing)
+                image.draft('RGB', (biggest, biggest))
+            image.load()
+            # the biggest variants first, so every smaller one is scaled down from the previous one
+            for v in sorted(missing, key=lambda x: -(x.size or max(image.size))):
+                if v.size is not None and max(image.size) > v.size:
+                    image = image.copy()
+                    image.thumbnail((v.size, v.size), Image.LANCZOS)
+                output = image
+                if v.format == 'jpeg' and output.mode not in ('RGB', 'L'):
+                    output = output.convert('RGB')
+                part_file = files[v.name] + ".part"
+                output.save(part_file, format=v.format, quality=v.quality)
+                os.replace(part_file, files[v.name])
+    return files, time.monotonic() - start
+
+
+class ImageProcessor(object):
+    """
+    Makes the variants of the downloaded images on a pool of processes, so that resizing and encoding use all
+    cores while the threads of the scraper keep downloading. Needs Pillow.
+    """
+
+    def __init__(self, variants: Sequence[ImageVariant], processes: Optional[int] = None):
+        try:
+            import PIL  # noqa: F401
+        except ImportError as e:
+            raise ImportError("Image variants need Pillow: pip install Pillow") from e
+        self.__variants = list(variants)
+        # spawned workers do not inherit the threads and open connections of the scraper
+        self.__executor = ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                                              mp_context=multiprocessing.get_context('spawn'))
+
+    @property
+    def variants(self) -> List[ImageVariant]:
+        return self.__variants
+
+    def submit(self, image_file: str) -> Future:
+        """
+        :return: future of the result of make_variants for image_file
+        """
+        return self.__executor.submit(make_variants, image_file, self.__variants)
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+from typing import Dict, List, Tuple
+
+from .concurrency import HostScheduler
+from .main import run
+
+_log = logging.getLogger(__name__)
+
+_REQUIRED = ('scrape', 'input_file', 'output_folder')
+
+
+def read_jobs(job_file: str) -> Tuple[HostScheduler, List[Dict]]:
+    """
+    Reads a job file, a json object with the runs and the request budgets they share:
+
+        {
+          "max_requests": 24,
+          "host_limit": 8,
+          "hosts": {"www.vam.ac.uk": 4, "media.vam.ac.uk": 8},
+          "jobs": [
+            {"scrape": "vanda", "input_file": "vanda.csv", "output_folder": "out/vanda", "concurrency": 8},
+            {"scrape": "wallace", "input_file": "wallace.csv", "output_folder": "out/wallace", "concurrency": 8}
+          ]
+        }
+
+    Every job takes the arguments of run. max_requests caps the requests in flight of all jobs together
+    (16 if not set), hosts sets the budget of single hosts and host_limit the budget of every other host.
+
+    :return: the scheduler of the budgets and the arguments of run of every job
+    """
+    with open(job_file, 'r', encoding='utf-8') as fi:
+        config = json.load(fi)
+
+    jobs = config.get('jobs') or []
+    if not jobs:
+        raise ValueError(f"No jobs in '{job_file}'")
+
+    import inspect
+
+    parameters = set(inspect.signature(run).parameters) - {'scheduler'}
+    output_folders = set()
+    for i, job in enumerate(jobs):
+        missing = [k for k in _REQUIRED if k not in job]
+        if missing:
+            raise ValueError(f"Job {i} in '{job_file}' is missing {', '.join(missing)}")
+        unknown = sorted(set(job) - parameters)
+        if unknown:
+            raise ValueError(f"Job {i} in '{job_file}' has unknown options: {', '.join(unknown)}")
+        output_folder = os.path.abspath(job['output_folder'])
+        if output_folder in output_folders:
+            raise ValueError(f"Job {i} in '{job_file}' writes to the output folder of another job: "
+                             f"'{job['output_folder']}'")
+        output_folders.add(output_folder)
+
+    scheduler = HostScheduler(max_requests=config.get('max_requests', 16), host_limits=config.get('hosts'),
+                              default_host_limit=config.get('host_limit'))
+    return scheduler, jobs
+
+
+def run_jobs(job_file: str):
+    """
+    Runs all jobs of a job file at the same time, each in its own thread, with the requests of all of them
+    scheduled within the budgets of the job file. A job that fails does not stop the others.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    scheduler, jobs = read_jobs(job_file)
+    _log.info("Running %s jobs, at most %s requests at a time", len(jobs), scheduler.max_requests)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="job") as executor:
+        futures = [executor.submit(run, scheduler=scheduler, **job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+                _log.info("Finished job %s -> '%s'", job['scrape'], job['output_folder'])
+            except Exception as e:
+                _log.error("Job %s -> '%s' failed: %s", job['scrape'], job['output_folder'], e, exc_info=True)
+                failed.append(job['output_folder'])
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(jobs)} jobs failed: {', '.join(failed)}")
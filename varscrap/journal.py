@@ -0,0 +1,79 @@
+import logging
+import os
+import sys
+from threading import Lock
+from typing import Dict
+
+_log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    An append-only log of the progress of a scrape run, used to resume interrupted runs.
+
+    Every line records that one stage of one item is finished: "<stage>\\t<item_id>\\n".
+    The log is read once into memory when it is opened, so membership checks are O(1),
+    and every mark is a single flushed append, so a crash loses at most the items in flight.
+    """
+
+    METADATA = 'metadata'
+    IMAGE = 'image'
+    FAILED = 'failed'
+
+    # the finished stages of an item are kept as bits of one int, which is much smaller than a set per item
+    __FLAGS = {METADATA: 1, IMAGE: 2, FAILED: 4}
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__lock = Lock()
+        self.__stages: Dict[str, int] = {}
+
+        if os.path.isfile(path):
+            with open(path, 'r') as fi:
+                for line in fi:
+                    # a line without newline was cut off by a crash
+                    if not line.endswith("\n"):
+                        continue
+                    stage, _, item_id = line.rstrip("\n").partition("\t")
+                    flag = self.__FLAGS.get(stage)
+                    if flag is not None and item_id:
+                        item_id = sys.intern(item_id)
+                        self.__stages[item_id] = self.__stages.get(item_id, 0) | flag
+            _log.info("Resuming from journal '%s' with %s items", path, len(self.__stages))
+
+        self.__file = open(path, 'a')
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __len__(self):
+        return len(self.__stages)
+
+    def __contains__(self, item_id: str) -> bool:
+        return self.is_done(item_id)
+
+    def is_done(self, item_id: str, stage: str = IMAGE) -> bool:
+        return self.__stages.get(item_id, 0) & self.__FLAGS.get(stage, 0) != 0
+
+    def mark(self, item_id: str, stage: str):
+        flag = self.__FLAGS.get(stage)
+        if flag is None:
+            raise ValueError(f"Unknown journal stage: '{stage}'")
+        with self.__lock:
+            stages = self.__stages.get(item_id, 0)
+            if stages & flag:
+                return
+            self.__stages[item_id] = stages | flag
+            self.__file.write(f"{stage}\t{item_id}\n")
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -2,10 +2,17 @@ import logging
 
 import os
 
+from .distributed import parse_shard, shard_folder
+from .metrics import MetricsReporter
+
 _log = logging.getLogger(__name__)
 
 
-def run(scrape, input_file, output_folder, overwrite=False):
+def run(scrape, input_file, output_folder, overwrite=False, concurrency=1, pool_size=10, cache_dir=None,
+        cache_size=1024 ** 3, blob_store=None, browsers=1, min_concurrency=1, max_concurrency=10,
+        stats_interval=10, metrics_port=None, records='json', batch_size=1000, backend='files',
+        shard_size=1024 ** 3, shard=None, delta=False, image_variants=None, image_processes=None,
+        lookup_batch=1, scheduler=None):
     if scrape.lower() == 'vanda':
         from .scrapers.v_and_a import VandA as Scraper
         _log.info("Using V&A interface")
@@ -19,8 +26,28 @@ def run(scrape, input_file, output_folder, overwrite=False):
         _log.error("Using an interface that is not supported.")
         raise ValueError(f"This scraper is unsupported: '{scrape}'")
 
+    shard = parse_shard(shard)
+    if shard is not None:
+        output_folder = shard_folder(output_folder, shard)
+        _log.info("Worker %s of %s, writing to '%s'", shard[0], shard[1], output_folder)
+
     if not os.path.isdir(output_folder):
         os.makedirs(output_folder, exist_ok=True)
 
-    scraper = Scraper()
-    scraper.scrape(input_file=input_file, output=output_folder, overwrite=overwrite)
+    variants = []
+    if image_variants:
+        from .images import ImageVariant
+        variants = [v if isinstance(v, ImageVariant) else ImageVariant.parse(v) for v in image_variants]
+
+    scraper = Scraper(pool_size=max(pool_size, concurrency, max_concurrency), cache_dir=cache_dir,
+                      cache_size=cache_size, blob_store=blob_store, image_variants=variants,
+                      image_processes=image_processes, scheduler=scheduler)
+    try:
+        with MetricsReporter(scraper.metrics, stats_file=os.path.join(output_folder, "stats.json"),
+                             interval=stats_interval, port=metrics_port):
+            scraper.scrape(input_file=input_file, output=output_folder, overwrite=overwrite, concurrency=concurrency,
+                           browsers=browsers, min_concurrency=min_concurrency, max_concurrency=max_concurrency,
+                           records=records, batch_size=batch_size, backend=backend, shard_size=shard_size,
+                           shard=shard, delta=delta, lookup_batch=lookup_batch)
+    finally:
+        scraper.close()
@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from tempfile import NamedTemporaryFile
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Optional, Tuple
+
+_log = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _label_string(labels: Labels) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+
+def _bound(bound):
+    return "+Inf" if bound == float('inf') else bound
+
+
+class Histogram(object):
+    """
+    Counts observations in cumulative buckets like a Prometheus histogram.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        :return: the upper bound of the bucket the q-quantile falls into or None without observations
+        """
+        if self.count == 0:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+        return None
+
+
+class Metrics(object):
+    """
+    Counters, latency histograms and gauges of a scraper run, shared by all threads of the scraper.
+
+    Every metric has a name and optional labels, e.g. the stage a latency was measured in.
+    Gauges are either changed with add or read from a function whenever the metrics are reported,
+    e.g. the size of a queue.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__start = time.monotonic()
+        self.__counters: Dict[Tuple[str, Labels], float] = {}
+        self.__gauges: Dict[Tuple[str, Labels], float] = {}
+        self.__gauge_functions: Dict[Tuple[str, Labels], Callable[[], float]] = {}
+        self.__histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__gauges[key] = self.__gauges.get(key, 0) + value
+
+    def gauge(self, name: str, function: Optional[Callable[[], float]], **labels):
+        """
+        Reports the return value of function as gauge, None removes the gauge.
+        """
+        key = (name, _labels(labels))
+        with self.__lock:
+            if function is None:
+                self.__gauge_functions.pop(key, None)
+            else:
+                self.__gauge_functions[key] = function
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, stage: str):
+        """
+        Measures the latency of the enclosed stage, e.g. "fetch", "parse", "write" or "image";
+        stages that raise are counted as errors as well.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe("stage_seconds", time.monotonic() - start, stage=stage)
+
+    @contextmanager
+    def in_flight(self, name: str, **labels):
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+    def __read_gauges(self) -> Dict[Tuple[str, Labels], float]:
+        with self.__lock:
+            gauges = dict(self.__gauges)
+            functions = list(self.__gauge_functions.items())
+        for key, function in functions:
+            try:
+                gauges[key] = function()
+            except Exception as e:
+                _log.debug("Cannot read gauge %s: %s", key[0], e)
+        return gauges
+
+    def snapshot(self) -> Dict:
+        """
+        :return: all metrics as json serialisable dict, labels are written as 'key="value"' strings
+        """
+        gauges = self.__read_gauges()
+        with self.__lock:
+            counters = dict(self.__counters)
+            histograms = {key: (list(h.cumulative()), h.count, h.sum, h.quantile(0.5), h.quantile(0.99))
+                          for key, h in self.__histograms.items()}
+
+        result = {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'elapsed': time.monotonic() - self.__start,
+            'counters': {},
+            'gauges': {},
+            'histograms': {}
+        }
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].setdefault(name, {})[_label_string(labels)] = value
+        for (name, labels), value in sorted(gauges.items()):
+            result['gauges'].setdefault(name, {})[_label_string(labels)] = value
+        for (name, labels), (buckets, count, total, p50, p99) in sorted(histograms.items()):
+            result['histograms'].setdefault(name, {})[_label_string(labels)] = {
+                'count': count,
+                'sum': total,
+                'p50': _bound(p50),
+                'p99': _bound(p99),
+                'buckets': {str(_bound(bound)): n for bound, n in buckets}
+            }
+        return result
+
+    def to_prometheus(self, prefix: str = "varscrap_") -> str:
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def series(name, labels, extra=""):
+            labels = ",".join(x for x in (labels, extra) if x)
+            return f"{prefix}{name}{{{labels}}}" if labels else f"{prefix}{name}"
+
+        for name, values in snapshot['counters'].items():
+            lines.append(f"# TYPE {prefix}{name} counter")
+            lines.extend(f"{series(name, labels)} {value}" for labels, value in values.items())
+        for name, values in snapshot['gauges'].items():
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.extend(f"{series(name, labels)} {value}" for labels, value in values.items())
+        for name, values in snapshot['histograms'].items():
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for labels, histogram in values.items():
+                for bound, count in histogram['buckets'].items():
+                    le = f'le="{bound}"'
+                    lines.append(f"{series(name + '_bucket', labels, le)} {count}")
+                lines.append(f"{series(name + '_sum', labels)} {histogram['sum']}")
+                lines.append(f"{series(name + '_count', labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, file: str):
+        """
+        Replaces file with the current snapshot, readers never see a half-written file.
+        """
+        with NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(file)), suffix=".tmp",
+                                delete=False) as fo:
+            json.dump(self.snapshot(), fo, indent=2)
+        os.replace(fo.name, file)
+
+
+class MetricsReporter(object):
+    """
+    Writes the metrics to a json stats file every interval seconds and, if a port is given,
+    serves them in the Prometheus text format on http://<host>:<port>/metrics while it runs.
+    Use it as a context manager around the scraping; the stats file is written a last time when it ends.
+    """
+
+    def __init__(self, metrics: Metrics, stats_file: Optional[str] = None, interval: float = 10,
+                 port: Optional[int] = None, host: str = "127.0.0.1"):
+        self.__metrics = metrics
+        self.__stats_file = stats_file
+        self.__interval = interval
+        self.__port = port
+        self.__host = host
+        self.__stopped = Event()
+        self.__thread: Optional[Thread] = None
+        self.__server = None
+
+    def start(self):
+        if self.__stats_file is not None and self.__interval > 0:
+            self.__thread = Thread(target=self.__run, name="MetricsReporter", daemon=True)
+            self.__thread.start()
+        if self.__port is not None:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            metrics = self.__metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.to_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.__server = ThreadingHTTPServer((self.__host, self.__port), Handler)
+            self.__server.daemon_threads = True
+            Thread(target=self.__server.serve_forever, name="MetricsServer", daemon=True).start()
+            _log.info("Serving metrics on http://%s:%s/metrics", self.__host, self.__server.server_address[1])
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval):
+            self.__write()
+
+    def __write(self):
+        try:
+            self.__metrics.write_json(self.__stats_file)
+        except OSError as e:
+            _log.warning("Cannot write stats file '%s': %s", self.__stats_file, e)
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+        if self.__stats_file is not None:
+            self.__write()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock, Thread
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    import requests
+
+_log = logging.getLogger(__name__)
+
+
+class FetchError(Exception):
+    """
+    A request did not return what was needed, e.g. an error status or an image that could not be downloaded.
+    """
+
+    def __init__(self, url: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(f"Could not fetch '{url}'" + (f": Code {status_code}" if status_code else ""))
+        self.url = url
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response: 'requests.Response') -> 'FetchError':
+        return cls(response.url, response.status_code, _parse_retry_after(response.headers.get('Retry-After')))
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter: the n-th retry waits between half and all of min(max_delay, base_delay * 2^n).
+    """
+
+    def __init__(self, max_tries: int, base_delay: float, max_delay: float):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, tries: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** tries)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RetryScheduler(object):
+    """
+    Decides if and when a failed item is tried again, runs the retries after their delay without blocking a
+    worker in the meantime, and writes items that failed for good to a dead letter file (one json object per line).
+
+    Errors are grouped into classes with their own policy:
+    timeouts, connection errors, server errors (5xx), throttling (429, waiting at least Retry-After)
+    and failures without a status ("failed"). Other errors, e.g. 404 or unexpected content, are not retried.
+    """
+
+    POLICIES = {
+        'timeout': RetryPolicy(max_tries=4, base_delay=2, max_delay=60),
+        'connection': RetryPolicy(max_tries=4, base_delay=2, max_delay=60),
+        'server_error': RetryPolicy(max_tries=4, base_delay=5, max_delay=120),
+        'throttled': RetryPolicy(max_tries=6, base_delay=10, max_delay=300),
+        'failed': RetryPolicy(max_tries=3, base_delay=1, max_delay=10),
+    }
+
+    def __init__(self, dead_letter_file: Optional[str] = None, policies: Optional[Dict[str, RetryPolicy]] = None):
+        self.__dead_letter_file = dead_letter_file
+        self.__policies = dict(self.POLICIES, **(policies or {}))
+        self.__delayed = []
+        self.__counter = itertools.count()
+        self.__condition = Condition()
+        self.__dead_letter_lock = Lock()
+        self.__thread: Optional[Thread] = None
+        self.__closed = False
+
+    @staticmethod
+    def classify(error: Exception) -> Tuple[Optional[str], Optional[float]]:
+        """
+        :return: the error class (None if it must not be retried) and the delay the server asked for
+        """
+        import requests
+
+        if isinstance(error, requests.Timeout):
+            return 'timeout', None
+        if isinstance(error, requests.ConnectionError):
+            return 'connection', None
+        if isinstance(error, FetchError):
+            if error.status_code is None:
+                return 'failed', None
+            if error.status_code == 429:
+                return 'throttled', error.retry_after
+            if error.status_code == 408:
+                return 'timeout', None
+            if error.status_code >= 500:
+                return 'server_error', error.retry_after
+        return None, None
+
+    def next_delay(self, error: Exception, tries: int) -> Optional[float]:
+        """
+        :param error: the error of the last try
+        :param tries: number of tries so far
+        :return: seconds to wait before the next try or None if the item should not be tried again
+        """
+        error_class, retry_after = self.classify(error)
+        if error_class is None:
+            return None
+        policy = self.__policies[error_class]
+        if tries >= policy.max_tries:
+            return None
+        return max(policy.delay(tries - 1), retry_after or 0)
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        with self.__condition:
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name="RetryScheduler", daemon=True)
+                self.__thread.start()
+            heapq.heappush(self.__delayed, (time.monotonic() + delay, next(self.__counter), callback))
+            self.__condition.notify()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__closed and (
+                        not self.__delayed or self.__delayed[0][0] > time.monotonic()):
+                    timeout = self.__delayed[0][0] - time.monotonic() if self.__delayed else None
+                    self.__condition.wait(timeout)
+                if self.__closed:
+                    return
+                _, _, callback = heapq.heappop(self.__delayed)
+            try:
+                callback()
+            except Exception as e:
+                _log.error("Retry failed to start: %s", e)
+
+    def dead_letter(self, item_id: str, error: Optional[Exception], tries: int):
+        _log.error("Giving up on '%s' after %s tries: %s", item_id, tries, error)
+        if self.__dead_letter_file is None:
+            return
+        entry = {
+            'item_id': item_id,
+            'error': repr(error),
+            'status_code': getattr(error, 'status_code', None),
+            'tries': tries,
+            'time': datetime.now(timezone.utc).isoformat()
+        }
+        with self.__dead_letter_lock, open(self.__dead_letter_file, 'a') as fo:
+            fo.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
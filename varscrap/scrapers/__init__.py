@@ -1,15 +1,70 @@
 import logging
 import os
+import time
+import zlib
 from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Lock
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
 
-import pandas as pd
-import requests
+from ..blobstore import BlobStore
+from ..concurrency import AdaptiveLimiter, HostScheduler
+from ..converters.zotero import ZoteroData
+from ..delta import Manifest, annotated_objects, patch_annotations, patch_records
+from ..journal import Journal
+from ..metrics import Metrics
+from ..retry import RetryScheduler
+from ..sinks import RecordSink, open_sink
+
+# requests (and the response cache, which needs it) are imported on first use, to keep the import of the
+# scrapers fast
+if TYPE_CHECKING:
+    import requests
+
+    from ..images import ImageVariant
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
 class Scraper(ABC):
     _LOG = logging.getLogger("Scraper")
+    _CHUNK_SIZE = 1024 ** 2
+    # set by scrapers whose worker pool adapts to the observed latency and errors
+    _limiter: Optional[AdaptiveLimiter] = None
+
+    def __init__(self, pool_size: int = 10, timeout: float = 30, cache_dir: Optional[str] = None,
+                 cache_size: int = 1024 ** 3, blob_store: Optional[str] = None,
+                 image_variants: Sequence['ImageVariant'] = (), image_processes: Optional[int] = None,
+                 scheduler: Optional[HostScheduler] = None):
+        """
+        :param pool_size: number of keep-alive connections that are kept open per host
+        :param timeout: seconds to wait for a server to connect or send data
+        :param cache_dir: folder of the persistent response cache, no responses are cached if not set
+        :param cache_size: maximal size in bytes of the cached responses
+        :param blob_store: folder of a content-addressed image store shared between output folders,
+                           images are saved directly in the output folder if not set
+        :param image_variants: variants (e.g. resized or thumbnails) that are made of every downloaded image
+        :param image_processes: number of processes that make the variants, one per core if not set
+        :param scheduler: request budgets per host shared with the other scrapers of the process, if any
+        """
+        self.__pool_size = pool_size
+        self.__timeout = timeout
+        self.__session = None
+        self.__session_lock = Lock()
+        self.__cache = None
+        if cache_dir:
+            from ..cache import ResponseCache
+            self.__cache = ResponseCache(cache_dir, max_size=cache_size)
+        self.__blob_store = BlobStore(blob_store) if blob_store else None
+        self.__metrics = Metrics()
+        self.__scheduler = scheduler
+        self.__images = None
+        if image_variants:
+            from ..images import ImageProcessor
+            self.__images = ImageProcessor(image_variants, processes=image_processes)
 
     @property
     @abstractmethod
@@ -20,21 +75,234 @@ class Scraper(ABC):
     def scrape(self, **kwargs):
         pass
 
+    @property
+    def metrics(self) -> Metrics:
+        """
+        Counters, latency histograms per stage ("fetch", "parse", "write", "image", "variants" and, with a
+        scheduler, "schedule") and gauges of this scraper.
+        """
+        return self.__metrics
+
+    @property
+    def _session(self) -> 'requests.Session':
+        """
+        The connection-pooled HTTP session shared by all requests (and threads) of this scraper.
+        Cookies are never stored in the session, they have to be passed per request.
+        """
+        with self.__session_lock:
+            if self.__session is None:
+                from http.cookiejar import DefaultCookiePolicy
+
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=self.__pool_size, pool_maxsize=self.__pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.__session = session
+        return self.__session
+
+    def _get(self, url: str, **kwargs) -> 'requests.Response':
+        """
+        GET request through the shared session.
+        Unless the response is streamed, it is served from the response cache if the server confirms it
+        is not modified.
+        """
+        kwargs.setdefault('timeout', self.__timeout)
+        if self.__cache is None or kwargs.get('stream'):
+            return self.__request(url, **kwargs)
+
+        meta = self.__cache.lookup(url)
+        if meta is not None:
+            kwargs['headers'] = {**self.__cache.conditional_headers(meta), **kwargs.get('headers', {})}
+
+        response = self.__request(url, **kwargs)
+
+        if meta is not None and response.status_code == 304:
+            self._LOG.debug("Not modified, using cached response: %s", url)
+            revived = self.__cache.revive(response, meta)
+            if revived is not None:
+                self.__metrics.inc("cache_hits_total")
+                return revived
+            kwargs['headers'] = {k: v for k, v in kwargs['headers'].items()
+                                 if k not in self.__cache.conditional_headers(meta)}
+            response = self.__request(url, **kwargs)
+
+        self.__cache.store(url, response)
+        return response
+
+    def __request(self, url: str, **kwargs) -> 'requests.Response':
+        import requests
+
+        # streamed responses are downloads, their time and bytes are measured by the image stage,
+        # which also holds their slot of the scheduler until the body is read
+        stream = kwargs.get('stream', False)
+        with nullcontext() if stream else self.__slot(url):
+            start = time.monotonic()
+            try:
+                with self.__metrics.in_flight("requests_in_flight"), \
+                        nullcontext() if stream else self.__metrics.time("fetch"):
+                    response = self._session.get(url, **kwargs)
+            except requests.RequestException as e:
+                self.__metrics.inc("requests_total", status=type(e).__name__)
+                if self._limiter is not None:
+                    self._limiter.record(time.monotonic() - start)
+                raise
+
+        self.__metrics.inc("requests_total", status=response.status_code)
+        if not stream:
+            self.__metrics.inc("received_bytes_total", len(response.content), stage="fetch")
+        if self._limiter is not None:
+            self._limiter.record(time.monotonic() - start, response.status_code)
+        return response
+
+    @contextmanager
+    def __slot(self, url: str):
+        """
+        Holds a slot of the scheduler for the host of url, the time it waits for it is measured as "schedule" stage.
+        """
+        if self.__scheduler is None:
+            yield
+            return
+        host = urlsplit(url).hostname or ""
+        start = time.monotonic()
+        with self.__scheduler.slot(host):
+            self.__metrics.observe("stage_seconds", time.monotonic() - start, stage="schedule")
+            yield
+
     @staticmethod
-    def _load_csv(csv_file: str) -> pd.DataFrame:
-        df = pd.read_csv(
-            csv_file,
-            delimiter=',',
-            index_col=['Key'],
-            na_filter=False
-        )
+    def _bounded_map(func: Callable, items: Iterable, concurrency: int = 1,
+                     scheduler: Optional[RetryScheduler] = None,
+                     on_failure: Optional[Callable[[object, Exception, int], None]] = None) -> Iterator:
+        """
+        Applies func to every item on a pool of concurrency threads and yields the results in input order.
+        Items are pulled lazily and at most 2 * concurrency of them are in flight or waiting to be consumed,
+        so memory stays constant no matter how many items there are.
+
+        With a scheduler, an item whose call raised is called again after the delay decided by the scheduler;
+        no worker is blocked while it waits. A retried item leaves the ordered window, so the items after it go on
+        while it waits, and its result is yielded as soon as a retry succeeds; at most 2 * concurrency items wait
+        for a retry at the same time. Items that fail for good are passed to on_failure and skipped,
+        without on_failure their error is raised.
+
+        :param func: function that is called for every item
+        :param items: the (possibly lazy) input items
+        :param concurrency: number of items that are processed at the same time
+        :param scheduler: retry scheduler for failed calls, failed calls are not retried if None
+        :param on_failure: called with (item, error, tries) for items that failed for good
+        :return: the results of func, in the order of items apart from retried items
+        """
+        skipped = object()
+        # result of an item of the ordered window that is retried, its result is yielded from retried_results
+        retried = object()
+        condition = Condition()
+        pending = deque()
+        retried_results = deque()
+        retrying = 0
+
+        def finish_retry(value, error: Optional[Exception] = None):
+            nonlocal retrying
+            with condition:
+                retrying -= 1
+                retried_results.append((value, error))
+                condition.notify_all()
+
+        def notify(_):
+            with condition:
+                condition.notify_all()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            def attempt(item, result: Optional[Future], tries: int):
+                nonlocal retrying
+                try:
+                    value = func(item)
+                except Exception as e:
+                    delay = scheduler.next_delay(e, tries) if scheduler is not None else None
+                    if delay is not None:
+                        Scraper._LOG.warning("Try %s failed for %s: %s (retrying in %.1fs)", tries, item, e, delay)
+                        if result is not None:
+                            with condition:
+                                retrying += 1
+                            result.set_result(retried)
+                        scheduler.call_later(delay, lambda: executor.submit(attempt, item, None, tries + 1))
+                        return
+                    if on_failure is None:
+                        if result is not None:
+                            result.set_exception(e)
+                        else:
+                            finish_retry(None, e)
+                        return
+                    try:
+                        on_failure(item, e, tries)
+                    finally:
+                        if result is not None:
+                            result.set_result(skipped)
+                        else:
+                            finish_retry(skipped)
+                    return
+                if result is not None:
+                    result.set_result(value)
+                else:
+                    finish_retry(value)
+
+            def submit(item) -> Future:
+                result = Future()
+                result.add_done_callback(notify)
+                executor.submit(attempt, item, result, 1)
+                return result
 
-        return df
+            def ready(block: bool) -> List:
+                """
+                :return: the results that can be yielded, waits until there is one if block
+                """
+                with condition:
+                    if block:
+                        condition.wait_for(lambda: retried_results or (pending and pending[0].done()))
+                    finished = list(retried_results)
+                    retried_results.clear()
+                results = []
+                for value, error in finished:
+                    if error is not None:
+                        raise error
+                    results.append(value)
+                while pending and pending[0].done():
+                    results.append(pending.popleft().result())
+                return [r for r in results if r is not skipped and r is not retried]
+
+            for item in items:
+                pending.append(submit(item))
+                yield from ready(block=False)
+                while len(pending) >= 2 * concurrency or retrying >= 2 * concurrency:
+                    yield from ready(block=True)
+            while pending or retrying or retried_results:
+                yield from ready(block=True)
+
+    def _retry_scheduler(self, output: str) -> RetryScheduler:
+        """
+        :return: a retry scheduler that writes items that failed for good to dead_letter.jsonl in the output folder
+        """
+        return RetryScheduler(os.path.join(output, "dead_letter.jsonl"))
 
     @staticmethod
     def _check_input(kwargs) -> bool:
         return all(x in kwargs for x in ['input_file', 'output', 'overwrite'])
 
+    @staticmethod
+    def _in_shard(item_id: str, shard: Optional[Tuple[int, int]]) -> bool:
+        """
+        Static partitioning of the items between cooperating workers: worker i of N takes the items whose id
+        has a crc32 of i modulo N, so every worker knows its items without any coordination.
+
+        :param item_id: id of the item
+        :param shard: (i, N) or None if this is the only worker
+        """
+        if shard is None:
+            return True
+        index, count = shard
+        return zlib.crc32(item_id.encode('utf-8')) % count == index
+
     @staticmethod
     def _prepare_output(output: str, overwrite: bool = False):
         if overwrite:
@@ -44,17 +312,241 @@ class Scraper(ABC):
         if not os.path.isdir(output):
             os.makedirs(output, exist_ok=True)
 
+    def _open_journal(self, output: str) -> Journal:
+        """
+        Opens the resume journal of an output folder.
+        Ids of an old style downloaded.txt are taken over as finished when the journal is new.
+        """
+        journal = Journal(os.path.join(output, "journal.log"))
+
+        legacy_progress_file = os.path.join(output, "downloaded.txt")
+        if len(journal) == 0 and os.path.isfile(legacy_progress_file):
+            with open(legacy_progress_file, 'r') as fi:
+                for line in fi:
+                    if line.strip():
+                        journal.mark(line.strip(), Journal.IMAGE)
+            self._log.info("Took over %s finished items from '%s'", len(journal), legacy_progress_file)
+
+        return journal
+
+    @staticmethod
+    def _open_manifest(output: str) -> Manifest:
+        """
+        Opens the manifest of the Zotero export that the last delta run of an output folder processed.
+        """
+        return Manifest(os.path.join(output, "manifest.jsonl"))
+
+    def _apply_delta(self, manifest: Manifest, objects: Iterable[ZoteroData], annotation_file: str, id_column: str,
+                     renumber: bool = False, **kwargs) -> Tuple[List[ZoteroData], int]:
+        """
+        Delta mode: brings the outputs of the objects that were scraped before up to date with the export,
+        without fetching anything. Rows of removed objects are dropped from the annotation csv, the rows of all
+        other objects get their current tag, and so do the json records of the objects whose tags changed.
+        Records in other formats keep the tag they were scraped with.
+        The manifest has to be committed once the pending objects are scraped.
+
+        :param manifest: the manifest of the last delta run
+        :param objects: the objects of the current export
+        :param annotation_file: the annotation csv of the scraper
+        :param id_column: the column of the annotation csv with the object id
+        :param renumber: whether the first column of the annotation csv is the row number
+        :return: the objects that still have to be scraped, as they have no rows yet, in the order of the export,
+                 and the number of rows in the annotation csv
+        """
+        changes = manifest.diff(objects, done=annotated_objects(annotation_file, id_column))
+        self._log.info("Delta of the export: %s", changes)
+        rows = patch_annotations(annotation_file, id_column, changes.tags, renumber=renumber)
+
+        if changes.retagged:
+            if kwargs.get('records', 'json') == 'json' and kwargs.get('backend', 'files') == 'files':
+                patched = patch_records(kwargs['output'], changes.retagged)
+                self._log.info("Patched the tag of %s records", patched)
+            else:
+                self._log.warning("The records of %s objects keep their old tags, only json records are patched",
+                                  len(changes.retagged))
+        if changes.removed:
+            self._log.info("%s objects are not in the export anymore, their files are kept", len(changes.removed))
+
+        self._log.info("%s objects have to be scraped", len(changes.pending))
+        return changes.pending, rows
+
+    @staticmethod
+    def _open_sink(name: str, **kwargs) -> RecordSink:
+        """
+        Opens the sink for the metadata records chosen by the "records", "batch_size", "backend" and "shard_size"
+        options (one json file per object by default).
+        The files of a record must be passed to its add_files once they are downloaded.
+
+        :param name: file name of the records, if they are written to one file
+        """
+        return open_sink(kwargs.get('records', 'json'), kwargs['output'], name,
+                         batch_size=kwargs.get('batch_size', 1000),
+                         backend=kwargs.get('backend', 'files'),
+                         shard_size=kwargs.get('shard_size', 1024 ** 3))
+
     @staticmethod
-    def _download_image(image_url: str, target_file: str, **kwargs) -> bool:
-        r = requests.get(image_url, stream=True, **kwargs)
-        if r.ok:
-            with open(target_file, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
+    def _stored_images(records: RecordSink, record_id: str, variants: Sequence['ImageVariant']) -> Optional[List[str]]:
+        """
+        The image and variant columns of the annotation row of an object with a single image, by the names the
+        record sink stored them under, e.g. in a tar shard; variants that were not stored are "".
+
+        :return: the columns or None if the sink leaves the files in the output folder
+        """
+        stored_files = records.stored_files(record_id)
+        if stored_files is None:
+            return None
+        image = next((f for f in stored_files
+                      if f.endswith(".jpg") and not any(f.endswith(v.suffix) for v in variants)), "")
+        return [image] + [next((f for f in stored_files if f.endswith(v.suffix)), "") for v in variants]
+
+    def _restored_images(self, output: str, records: RecordSink, record_id: str, image_name: str) -> List[str]:
+        """
+        The image and variant columns of the annotation row of an object that an earlier run finished,
+        to give it back its row without fetching it; variants that are neither stored by the record sink
+        nor in the output folder are "".
+        """
+        stored = self._stored_images(records, record_id, self._image_variants)
+        if stored is not None:
+            return stored
+        variant_names = [v.file(image_name) for v in self._image_variants]
+        return [image_name] + [n if os.path.isfile(os.path.join(output, n)) else "" for n in variant_names]
+
+    def _download_image(self, image_url: str, target_file: str, **kwargs) -> bool:
+        """
+        Downloads an image to target_file, through the blob store if there is one.
+
+        :param image_url: url of the image
+        :param target_file: where the image is saved
+        :param kwargs: further arguments of the request, e.g. cookies
+        :return: whether the image was downloaded completely
+        """
+        with self.__metrics.time("image"):
+            if self.__blob_store is not None:
+                ok = self.__blob_store.fetch(image_url, target_file,
+                                             lambda file: self.__download_file(image_url, file, **kwargs))
+            else:
+                ok = self.__download_file(image_url, target_file, **kwargs)
+        self.__metrics.inc("images_total", result="ok" if ok else "failed")
+        return ok
+
+    @property
+    def _image_variants(self) -> List['ImageVariant']:
+        """
+        The variants that are made of every downloaded image, in the order of their annotation csv columns.
+        """
+        return self.__images.variants if self.__images is not None else []
+
+    def _process_image(self, image_file: str) -> Optional[Future]:
+        """
+        Starts making the variants of a downloaded image on the image processes, the calling thread goes on.
+        Variants that exist already are not made again.
+
+        :return: what _variant_files waits for, None if there are no variants
+        """
+        return self.__images.submit(image_file) if self.__images is not None else None
+
+    def _variant_files(self, image_file: str, processing: Optional[Future]) -> Dict[str, str]:
+        """
+        Waits until the variants of an image are made.
+
+        :param image_file: the image
+        :param processing: what _process_image returned for it
+        :return: the files of the variants by their name, without the variants that could not be made
+        """
+        if processing is None:
+            return {}
+        try:
+            files, seconds = processing.result()
+        except Exception as e:
+            self._log.warning("Cannot make the variants of '%s': %s", image_file, e)
+            self.__metrics.inc("variants_total", result="failed")
+            return {}
+        self.__metrics.observe("stage_seconds", seconds, stage="variants")
+        self.__metrics.inc("variants_total", result="ok")
+        return files
+
+    def close(self):
+        """
+        Stops the image processes once the variants in progress are made.
+        """
+        if self.__images is not None:
+            self.__images.close()
+
+    def __download_file(self, image_url: str, target_file: str, **kwargs) -> bool:
+        """
+        Downloads an image to "<target_file>.part" and renames it to target_file once it is complete,
+        so target_file never exists half-written. A .part file left by an interrupted download is continued
+        with a Range request. The size is checked against the Content-Length announced by the server.
+
+        :param image_url: url of the image
+        :param target_file: where the image is saved
+        :param kwargs: further arguments of the request, e.g. cookies
+        :return: whether the image was downloaded completely
+        """
+        import requests
+
+        part_file = target_file + ".part"
+        headers = dict(kwargs.pop('headers', None) or {})
+
+        for _ in range(2):
+            offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+            if offset > 0:
+                headers['Range'] = f"bytes={offset}-"
+            else:
+                headers.pop('Range', None)
+
+            try:
+                with self.__slot(image_url), self._get(image_url, stream=True, headers=headers, **kwargs) as r:
+                    if offset > 0 and (r.status_code == 416 or (
+                            r.status_code == 206 and
+                            not r.headers.get('Content-Range', '').startswith(f"bytes {offset}-"))):
+                        Scraper._LOG.debug("Cannot resume '%s', starting over", image_url)
+                        os.remove(part_file)
+                        continue
+                    if not r.ok:
+                        Scraper._LOG.error("Could not download image '{}': Code {}".format(image_url, r.status_code))
+                        return False
+
+                    expected_size = self.__expected_size(r, offset)
+                    if r.status_code != 206:
+                        offset = 0
+
+                    with open(part_file, 'ab' if offset > 0 else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=self._CHUNK_SIZE):
+                            f.write(chunk)
+                            self.__metrics.inc("received_bytes_total", len(chunk), stage="image")
+            except (requests.RequestException, OSError) as e:
+                Scraper._LOG.error("Could not download image '%s': %s", image_url, e)
+                return False
+
+            try:
+                size = os.path.getsize(part_file)
+                if expected_size is not None and size != expected_size:
+                    Scraper._LOG.error("Could not download image '%s': got %s of %s bytes", image_url, size,
+                                       expected_size)
+                    return False
+
+                os.replace(part_file, target_file)
+            except OSError as e:
+                Scraper._LOG.error("Could not download image '%s': %s", image_url, e)
+                return False
             Scraper._LOG.debug("Downloaded image: %s", image_url)
             return True
-        else:
-            Scraper._LOG.error("Could not download image '{}': Code {}".format(image_url, r.status_code))
 
         return False
+
+    @staticmethod
+    def __expected_size(r: 'requests.Response', offset: int) -> Optional[int]:
+        """
+        :return: the complete size of the file according to the response headers or None if it is unknown
+        """
+        if r.headers.get('Content-Encoding', 'identity') != 'identity':
+            return None
+        if r.status_code == 206:
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                return int(total)
+            length = r.headers.get('Content-Length')
+            return offset + int(length) if length and length.isdigit() else None
+        length = r.headers.get('Content-Length')
+        return int(length) if length and length.isdigit() else None
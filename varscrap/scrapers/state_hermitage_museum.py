@@ -1,25 +1,28 @@
-import json
+import csv
 import logging
 import os
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Container, Dict, Optional, List
 from queue import Queue
 from queue import Empty
 from threading import Thread
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import WebDriverException
-from selenium.common.exceptions import TimeoutException
 
-import pandas as pd
-import requests
-from lxml import html
+from lxml import etree, html
 
 from . import Scraper
+from ..concurrency import AdaptiveLimiter
+from ..delta import annotated_objects
+from ..journal import Journal
+from ..retry import FetchError
+from ..sinks import RecordSink
 
 
 class HermitageMuseumInformation(object):
+    __slots__ = ('__object_id', '__author', '__authors', '__title', '__place', '__workshop', '__date', '__school',
+                 '__material', '__technique', '__dimensions', '__inventory_nr', '__category', '__collection',
+                 '__sub_collection', '__image_url', '__tag', '__variant_names')
+
     def __init__(self, object_id: str, title: str, inventory_nr: str, place: Optional[str] = None,
                  workshop: Optional[str] = None, date: Optional[str] = None, author: Optional[str] = None,
                  authors: Optional[str] = None, school: Optional[str] = None, material: Optional[str] = None,
@@ -43,6 +46,7 @@ class HermitageMuseumInformation(object):
         self.__sub_collection = sub_collection
         self.__image_url = image_url
         self.__tag = None
+        self.__variant_names = {}
 
     @property
     def object_id(self):
@@ -124,6 +128,17 @@ class HermitageMuseumInformation(object):
     def tag(self, tag):
         self.__tag = tag
 
+    @property
+    def variant_names(self):
+        """
+        The file names of the variants of the image by variant name
+        """
+        return self.__variant_names
+
+    @variant_names.setter
+    def variant_names(self, variant_names):
+        self.__variant_names = variant_names
+
     def to_dict(self):
         return {
             'object_id': self.object_id,
@@ -160,9 +175,10 @@ class HermitageMuseum(Scraper):
     """
 
     __URL_PREFIX = "https://www.hermitagemuseum.org/"
-    __XPATH_table_format = "div[{0}]/div[{1}]/{2}/text()"
-    __XPATH_table = "//section[@class='her-data-table']"
-    __XPATH_image_url = "/html/body/div/div[2]/div[3]/div[2]/div/div/section/div[2]/div[3]/div[1]/section/div/div[1]/div/div/div/img/@src"
+    __SELENIUM_TIMEOUT = 5
+    __XPATH_table = etree.XPath("//section[@class='her-data-table']")
+    __XPATH_image_url = etree.XPath(
+        "/html/body/div/div[2]/div[3]/div[2]/div/div/section/div[2]/div[3]/div[1]/section/div/div[1]/div/div/div/img/@src")
     __keys = {"Author:": "author",
               "Authors:": "authors",
               "Title:": "title",
@@ -178,8 +194,11 @@ class HermitageMuseum(Scraper):
               "Category:": "category",
               "Collection:": "collection",
               "Subcollection:": "sub_collection"}
+    # labels of the data table, compared after collapsing all whitespace
+    __keys_normalised = {" ".join(k.split()): v for k, v in __keys.items()}
 
-    def __init__(self):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.__logger = logging.getLogger(__name__)
 
     @property
@@ -189,205 +208,412 @@ class HermitageMuseum(Scraper):
     def scrape(self, **kwargs):
         self._log.debug("Called scrape with options: %s", kwargs)
 
-        objects: List[str] = self._extract_all_from_search(kwargs['input_file'])
-
-        download_progress_file = os.path.join(kwargs['output'], "downloaded.txt")
-        download_failed_file = os.path.join(kwargs['output'], "failed.txt")
+        if kwargs.get('delta', False):
+            self._log.warning("The delta mode needs a Zotero export, the search results are scraped as usual")
+        objects: List[str] = self._extract_all_from_search(kwargs['input_file'], kwargs.get('browsers', 1))
 
-        if os.path.isfile(download_progress_file):
-            with open(download_progress_file, 'r') as fi:
-                download_progress = list(set([l.strip() for l in fi]))
-        else:
-            download_progress = []
+        journal = self._open_journal(kwargs['output'])
+        records = self._open_sink("hermitage_museum", **kwargs)
+        scheduler = self._retry_scheduler(kwargs['output'])
 
         queue = Queue()
         output_queue = Queue()
         failed_queue = Queue()
-        annotations = []
+
+        annotation_path = os.path.join(kwargs['output'], "hermitage_museum_annotation.csv")
+        # the rows of earlier runs are kept, the csv is appended to
+        annotated = annotated_objects(annotation_path, 'object_id')
+        annotation_file = open(annotation_path, 'a', newline='')
+        writer = csv.writer(annotation_file, lineterminator='\n')
+        if annotation_file.tell() == 0:
+            writer.writerow(['', 'object_id', 'tag', 'image_name'] +
+                            [f"image_name_{v.name}" for v in self._image_variants])
 
         for url in objects:
             id = url.split("/digital-collection/")[1].replace("/", "_")
-            if id not in download_progress:
+            if not self._in_shard(id, kwargs.get('shard')):
+                continue
+            if id not in journal:
                 queue.put((url, id, 0))
-
-        number_of_threads = min(queue.qsize(), 10)
+            elif id not in annotated:
+                # finished by an interrupted run that did not write its row
+                writer.writerow([id, id, ""] + self._restored_images(kwargs['output'], records, id, f"{id}.jpg"))
+        annotation_file.flush()
+
+        min_concurrency = kwargs.get('min_concurrency', 1)
+        max_concurrency = kwargs.get('max_concurrency', 10)
+        self._limiter = AdaptiveLimiter(min_limit=min_concurrency, max_limit=max_concurrency,
+                                        initial=(min_concurrency + max_concurrency) // 2)
+        self.metrics.gauge("queue_depth", queue.qsize, queue="pages")
+        self.metrics.gauge("queue_depth", output_queue.qsize, queue="output")
+        self.metrics.gauge("queue_depth", failed_queue.qsize, queue="failed")
+        self.metrics.gauge("concurrency_limit", lambda: self._limiter.limit)
+        self.metrics.gauge("workers_busy", lambda: self._limiter.in_flight)
+
+        number_of_threads = min(queue.qsize(), max_concurrency)
         if len(objects) > 0 and queue.qsize() == 0:
             self._log.error("All extracted URLs have already been downloaded.")
         self._log.info("Will scrap {} elements".format(queue.qsize()))
         threads = []
         self._log.debug("Starting {} Threads".format(number_of_threads))
         for i in range(number_of_threads):
-            t = Thread(target=self.__extract_page_worker, args=(kwargs['output'], queue, output_queue, failed_queue,))
+            t = Thread(target=self.__extract_page_worker,
+                       args=(kwargs['output'], queue, output_queue, failed_queue, journal, records, scheduler,))
             t.start()
             threads.append(t)
             self._log.debug("Started Thread: {}".format(i))
 
-        progress_file = open(download_progress_file, 'a')
-        failed_file = open(download_failed_file,'a')
-        progress_write_thread = Thread(target=self._write_progress_worker, args=(output_queue, progress_file, annotations, ))
-        failed_write_thread = Thread(target=self._write_progress_worker, args=(failed_queue, failed_file,))
+        progress_write_thread = Thread(target=self._write_progress_worker,
+                                       args=(output_queue, journal, Journal.IMAGE, writer, self._image_variants,
+                                             annotated, records, ))
+        failed_write_thread = Thread(target=self._write_progress_worker,
+                                     args=(failed_queue, journal, Journal.FAILED,))
         progress_write_thread.start()
         failed_write_thread.start()
         queue.join()
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        self._log.info("Finished with a concurrency of {}".format(self._limiter.limit))
         output_queue.join()
         failed_queue.join()
         output_queue.put(None)
         failed_queue.put(None)
-        progress_file.close()
-        failed_file.close()
-        df = pd.DataFrame(
-            [a.to_dict() for a in annotations],
-            index=[a.object_id for a in annotations],
-            columns=['object_id', 'tag', 'image_name'])
-
-        df.to_csv(os.path.join(kwargs['output'], "hermitage_museum_annotation.csv"))
-
-    def __extract_page_worker(self, output, queue, output_queue, failed_queue):
+        progress_write_thread.join()
+        failed_write_thread.join()
+        scheduler.close()
+        records.close()
+        journal.close()
+        annotation_file.close()
+
+    def __extract_page_worker(self, output, queue, output_queue, failed_queue, journal, records, scheduler):
         """
         Worker to threaded scrap a HermitageMuseumInformation object.
         All information is stored in queues to allow for inter thread communication.
+        The worker runs until it gets None from the queue; how many workers scrape at the same time
+        is decided by the adaptive limiter.
 
         :param output: path where the Information is written to
-        :param queue: queue of 3-tuples (url, obj_id, tries) that still need to be scraped
+        :param queue: queue of 3-tuples (url, obj_id, tries) that still need to be scraped, or None to stop
         :param output_queue: queue of all HermitageMuseumInformation objects
-        :param failed_queue: queue of all finally failed urls
+        :param failed_queue: queue of all finally failed obj_ids
+        :param journal: journal the finished metadata stage is recorded in
+        :param records: sink the records are written to
+        :param scheduler: retry scheduler that puts failed elements back into the queue after a delay
         :return: None
         """
-        while not queue.empty():
+        while True:
             obj = queue.get()
+            if obj is None:
+                break
             url = obj[0]
             obj_id = obj[1]
             tries = obj[2]
-            annotation: Optional[HermitageMuseumInformation] = self.__extract_page(url, obj_id, output)
-            if annotation is None and tries >= 2:
-                self._log.error(f"Object '{obj_id}' could not be downloaded")
-                failed_queue.put(url)
-            elif annotation is None:
+            try:
+                with self._limiter:
+                    annotation: Optional[HermitageMuseumInformation] = self.__extract_page(url, obj_id, output,
+                                                                                           journal, records)
+                error = FetchError(url) if annotation is None else None
+            except Exception as e:
+                annotation = None
+                error = e
+
+            if annotation is not None:
+                output_queue.put(annotation)
+                queue.task_done()
+                continue
+
+            delay = scheduler.next_delay(error, tries + 1)
+            if delay is None:
                 self._log.error(f"Object '{obj_id}' could not be downloaded")
-                queue.put((url, tries + 1))
+                failed_queue.put(obj_id)
+                scheduler.dead_letter(obj_id, error, tries + 1)
+                queue.task_done()
             else:
-                output_queue.put(annotation)
-            queue.task_done()
+                self._log.warning(f"Object '{obj_id}' could not be downloaded ({error}), retrying in {delay:.1f}s")
+                # the element only counts as done once its retry is back in the queue, so queue.join() waits for it
+                scheduler.call_later(delay, partial(self.__requeue, queue, (url, obj_id, tries + 1)))
+
+    @staticmethod
+    def __requeue(queue, obj):
+        queue.put(obj)
+        queue.task_done()
 
-    def __extract_page(self, obj, obj_id, output) -> Optional[HermitageMuseumInformation]:
+    def __extract_page(self, obj, obj_id, output, journal, records) -> Optional[HermitageMuseumInformation]:
         """
         Scraps all information from a work of art in the Hermitage Collection.
 
         :param obj: url to the result to be scraped
         :param obj_id: identifier of the result
         :param output: output folder where all results are saved
-        :return: information from the scraped page
+        :param journal: journal the finished metadata stage is recorded in
+        :param records: sink the record is written to
+        :return: information from the scraped page or None if it could not be parsed
         :rtype: HermitageMuseumInformation
+        :raises FetchError: if the page or the image could not be fetched
         """
 
         self._log.debug("Will scrape object_id '%s'", obj_id)
-        try:
-            page = requests.get(obj, cookies={})
-        except Exception as e:
-            self._log.debug(e)
+        page = self._get(obj)
+        if not page.ok:
+            raise FetchError.from_response(page)
+
+        with self.metrics.time("parse"):
+            values = self._parse_page(page.text)
+        if values is None:
             return None
-        if page.ok:
-            html_page = html.fromstring(page.text)
-            values = {}
-            i = 1
-            try:
-                table = html_page.xpath(self.__XPATH_table)[0]
-                while True:
-                    key_list = table.xpath(self.__XPATH_table_format.format(i, 1, "p"))
-                    if len(key_list) == 0:
-                        break
-                    key = key_list[0].replace("\n", "").rstrip(" ")
-                    if key not in self.__keys.keys():
-                        i = i + 1
-                        continue
-                    key = self.__keys[key]
-                    value_list = table.xpath(self.__XPATH_table_format.format(i, 2, "a"))
-                    if len(value_list) == 0:
-                        value_list = table.xpath(self.__XPATH_table_format.format(i, 2, "p"))
-                    values[key] = value_list[0].strip("\n").rstrip(" ")
-                    i = i + 1
-                values['image_url'] = self.__URL_PREFIX + html_page.xpath(self.__XPATH_image_url)[0]
-            except IndexError:
+        info = HermitageMuseumInformation(object_id=obj_id, **values)
+        info.tag = ""
+
+        # a retry after a failed image download finds the record written already
+        if not records.has_record(journal, info.object_id):
+            with self.metrics.time("write"):
+                records.write(info.object_id, info.to_dict())
+            records.mark(journal, info.object_id, Journal.METADATA)
+
+        target_image = os.path.join(output, info.image_name)
+        if not os.path.isfile(target_image):
+            image_ok = self._download_image(image_url=info.image_url,
+                                            target_file=target_image,
+                                            cookies=page.cookies)
+            if not image_ok:
+                raise FetchError(info.image_url)
+
+        variant_files = self._variant_files(target_image, self._process_image(target_image))
+        info.variant_names = {name: os.path.basename(file) for name, file in variant_files.items()}
+        files = {"jpg": target_image}
+        files.update((v.suffix[1:], variant_files[v.name]) for v in self._image_variants if v.name in variant_files)
+        records.add_files(info.object_id, files)
+        return info
+
+    @classmethod
+    def _parse_page(cls, text) -> Optional[Dict[str, str]]:
+        """
+        Extracts the fields of the data table and the image url of a work of art in one pass over the table rows.
+        Every row is a div with the label in its first and the value in its second div;
+        the table ends at the first row without label.
+
+        :param text: html of the page
+        :return: the fields by their HermitageMuseumInformation name or None if the page could not be parsed
+        """
+        html_page = html.fromstring(text)
+        table = cls.__XPATH_table(html_page)
+        image_url = cls.__XPATH_image_url(html_page)
+        if len(table) == 0 or len(image_url) == 0:
+            return None
+
+        values = {}
+        for row in table[0].iterchildren("div"):
+            cells = list(row.iterchildren("div"))
+            label = cls.__first_text(cells[0], "p") if len(cells) > 0 else None
+            if label is None:
+                break
+            key = cls.__keys_normalised.get(" ".join(label.split()))
+            if key is None:
+                continue
+            value = None
+            if len(cells) > 1:
+                value = cls.__first_text(cells[1], "a")
+                if value is None:
+                    value = cls.__first_text(cells[1], "p")
+            if value is None:
                 return None
-            info = HermitageMuseumInformation(object_id=obj_id, **values)
-            info.tag = ""
-
-            with open(os.path.join(output, f"{info.object_id}.json"), 'w') as fo:
-                json.dump(info.to_dict(), fo, indent=2)
-
-            target_image = os.path.join(output, info.image_name)
-            if not os.path.isfile(target_image):
-                image_ok = HermitageMuseum._download_image(image_url=info.image_url,
-                                                target_file=target_image,
-                                                cookies=page.cookies)
-                if not image_ok:
-                    return None
-            return info
-
-    def _extract_all_from_search(self, search_url):
+            values[key] = value.strip("\n").rstrip(" ")
+
+        values['image_url'] = cls.__URL_PREFIX + image_url[0]
+        return values
+
+    @staticmethod
+    def __first_text(cell, tag) -> Optional[str]:
+        """
+        :return: the first text node of the tag children of cell, like the xpath "tag/text()", or None
+        """
+        for element in cell.iterchildren(tag):
+            if element.text:
+                return str(element.text)
+            for child in element:
+                if child.tail:
+                    return str(child.tail)
+        return None
+
+    def _extract_all_from_search(self, search_url, browsers: int = 1):
         """
         This method extracts all result urls from a search request to the hermitage museum collection.
         This is done via selenium as the search page uses java script for pagination.
+        The number of result pages is read once, then the pages are split into contiguous ranges
+        that are harvested in parallel by a pool of headless browsers.
 
         :param search_url: url to the hermitage search page with the encoded search request
         :type search_url: str
-        :return: list of all url's to the results of the search request
+        :param browsers: number of browsers that harvest the result pages at the same time
+        :type browsers: int
+        :return: list of all url's to the results of the search request, without duplicates
         :rtype: list
         """
+        # selenium is only needed for the search, not for the pages of the results
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+
+        browser = None
+        try:
+            browser = self.__open_search(search_url, headless=browsers > 1)
+            max_page = max([1] + list(self.__pagination(browser).keys()))
+        except TimeoutException as e:
+            self._log.error("Timeout while extracting all URLs via Selenium: {}".format(e.msg))
+            self._log.error("No URLs have been extracted.")
+            self.__quit(browser)
+            return []
+        except WebDriverException as e:
+            self._log.error("Error while extracting all URLs via Selenium: {}".format(e.msg))
+            self._log.error("No URLs have been extracted.")
+            self.__quit(browser)
+            return []
+        except BaseException:
+            self.__quit(browser)
+            raise
+
+        number_of_browsers = max(1, min(browsers, max_page))
+        pages_per_browser = -(-max_page // number_of_browsers)
+        ranges = [(first, min(first + pages_per_browser - 1, max_page))
+                  for first in range(1, max_page + 1, pages_per_browser)]
+        self._log.info("Harvesting {} result pages with {} browsers".format(max_page, len(ranges)))
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(self.__harvest_pages, search_url, first, last, browser if i == 0 else None)
+                for i, (first, last) in enumerate(ranges)
+            ]
+            all_links = []
+            seen = set()
+            for future in futures:
+                for link in future.result():
+                    if link not in seen:
+                        seen.add(link)
+                        all_links.append(link)
+
+        if len(all_links) == 0:
+            self._log.error("No URLs have been extracted.")
+        return all_links
+
+    def __open_search(self, search_url, headless):
+        """
+        Opens the search page in a new Firefox and waits for the pagination.
+        """
+        from selenium import webdriver
+        from selenium.common.exceptions import WebDriverException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        options = webdriver.FirefoxOptions()
+        if headless:
+            options.add_argument("-headless")
+        browser = webdriver.Firefox(options=options)
         try:
-            browser = webdriver.Firefox()
             browser.get(search_url)
-            timeout = 5
-            max_page = 1
-            WebDriverWait(browser, timeout).until(EC.presence_of_element_located((By.CLASS_NAME, "her-pagination")))
-            pagination = browser.find_element_by_class_name("her-pagination")
-            li_elements = pagination.find_elements_by_tag_name("li")
-            for li_element in li_elements:
-                try:
-                    value = int(li_element.text)
-                    if value > max_page:
-                        max_page = value
-                except ValueError:
-                    pass
-            all_links = []
-            for i in range(1, max_page + 1):
-                row_elements = browser.find_elements_by_class_name("her-search-results-row")
-                for element in row_elements:
-                    link = element.find_element_by_tag_name("a").get_attribute("href")
-                    all_links.append(link)
-                    self._log.debug(link)
-                pagination = browser.find_element_by_class_name("her-pagination")
-                li_elements = pagination.find_elements_by_tag_name("li")
-                for li_element in li_elements:
-                    try:
-                        value = int(li_element.text)
-                        if value == i + 1:
-                            li_element.click()
-                            WebDriverWait(browser, timeout).until(EC.staleness_of(li_element))
-                            WebDriverWait(browser, timeout).until(
-                                EC.presence_of_element_located((By.CLASS_NAME, "her-pagination")))
-                            break
-                    except ValueError:
-                        pass
+            WebDriverWait(browser, self.__SELENIUM_TIMEOUT).until(
+                EC.presence_of_element_located((By.CLASS_NAME, "her-pagination")))
+        except WebDriverException:
             browser.quit()
-            if len(all_links) == 0:
-                self._log.error("No URLs have been extracted.")
-            return all_links
+            raise
+        return browser
+
+    @staticmethod
+    def __quit(browser):
+        """
+        Closes a browser that was opened for the search, if any, so that no Firefox is left running.
+        """
+        if browser is not None:
+            browser.quit()
+
+    @staticmethod
+    def __pagination(browser):
+        """
+        :return: the numbered pagination elements of the current page by their page number
+        """
+        from selenium.webdriver.common.by import By
+
+        pages = {}
+        pagination = browser.find_element(By.CLASS_NAME, "her-pagination")
+        for li_element in pagination.find_elements(By.TAG_NAME, "li"):
+            try:
+                pages[int(li_element.text)] = li_element
+            except ValueError:
+                pass
+        return pages
+
+    def __goto_page(self, browser, current, target):
+        """
+        Clicks through the pagination from page current to page target,
+        always jumping to the farthest page number that is shown and not beyond target.
+
+        :return: the page the browser is on
+        """
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        while current < target:
+            reachable = {v: li for v, li in self.__pagination(browser).items() if current < v <= target}
+            if len(reachable) == 0:
+                self._log.error("Cannot reach result page {} from page {}".format(target, current))
+                break
+            current = max(reachable)
+            li_element = reachable[current]
+            li_element.click()
+            WebDriverWait(browser, self.__SELENIUM_TIMEOUT).until(EC.staleness_of(li_element))
+            WebDriverWait(browser, self.__SELENIUM_TIMEOUT).until(
+                EC.presence_of_element_located((By.CLASS_NAME, "her-pagination")))
+        return current
+
+    def __harvest_pages(self, search_url, first, last, browser=None):
+        """
+        Collects the result links of the pages first to last (inclusive) of a search.
+
+        :param search_url: url to the hermitage search page with the encoded search request
+        :param first: first result page of this browser
+        :param last: last result page of this browser
+        :param browser: a browser that is on the first result page already, a new headless one is opened if None
+        :return: the links of all results on these pages, fewer if selenium failed on the way
+        """
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+        from selenium.webdriver.common.by import By
+
+        links = []
+        try:
+            if browser is None:
+                browser = self.__open_search(search_url, headless=True)
+            page = self.__goto_page(browser, 1, first)
+            while first <= page <= last:
+                for element in browser.find_elements(By.CLASS_NAME, "her-search-results-row"):
+                    link = element.find_element(By.TAG_NAME, "a").get_attribute("href")
+                    links.append(link)
+                    self._log.debug(link)
+                if page == last or self.__goto_page(browser, page, page + 1) != page + 1:
+                    break
+                page += 1
         except TimeoutException as e:
-            self._log.error("Timeout while extracting all URLs via Selenium: {}".format(e.msg))
+            self._log.error("Timeout while extracting URLs of pages {}-{} via Selenium: {}".format(first, last, e.msg))
         except WebDriverException as e:
-            self._log.error("Error while extracting all URLs via Selenium: {}".format(e.msg))
-        self._log.error("No URLs have been extracted.")
-        return []
+            self._log.error("Error while extracting URLs of pages {}-{} via Selenium: {}".format(first, last, e.msg))
+        finally:
+            if browser is not None:
+                browser.quit()
+        return links
 
     @staticmethod
-    def _write_progress_worker(output_queue, download_progress_file, annotations=None):
+    def _write_progress_worker(output_queue, journal, stage, writer=None, variants=(),
+                               annotated: Container[str] = (), records: Optional[RecordSink] = None):
         """
-        Worker to write the progress file.
+        Worker to write the progress to the journal.
 
         :param output_queue: queue with the HermitageMuseumInformation object or the obj_id of already scraped elements
-        :param download_progress_file: file where the progress is appended to
-        :param annotations: list of already scraped HermitageMuseumInformation objects
+        :param journal: journal the progress is appended to
+        :param stage: journal stage that is recorded for every element
+        :param writer: csv writer the annotation rows of the HermitageMuseumInformation objects are written to
+        :param variants: the image variants that have a column in the annotation rows
+        :param annotated: ids of the elements that have a row in the annotation csv already
+        :param records: sink of the records, which marks the journal once the record of an element is written
         :return: None
         """
         while True:
@@ -397,12 +623,19 @@ class HermitageMuseum(Scraper):
                     break
                 if isinstance(element, HermitageMuseumInformation):
                     progress = element.object_id
-                    if annotations is not None:
-                        annotations.append(element)
+                    if writer is not None and element.object_id not in annotated:
+                        # with a tar backend, the files are only in the shard, under the names it stored them
+                        images = None if records is None else Scraper._stored_images(records, element.object_id,
+                                                                                     variants)
+                        if images is None:
+                            images = [element.image_name] + [element.variant_names.get(v.name, "") for v in variants]
+                        writer.writerow([element.object_id, element.object_id, element.tag] + images)
                 else:
                     progress = element
-                download_progress_file.write(progress + "\n")
-                download_progress_file.flush()
+                if records is not None:
+                    records.mark(journal, progress, stage)
+                else:
+                    journal.mark(progress, stage)
                 output_queue.task_done()
             except Empty:
                 continue
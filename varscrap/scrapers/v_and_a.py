@@ -1,16 +1,22 @@
+import csv
+import itertools
 import json
 import logging
 import os
-from typing import List, Dict
-
-import pandas as pd
-import requests
+import re
+from typing import List, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlencode
 
 from . import Scraper
+from ..journal import Journal
+from ..retry import FetchError
+from ..sinks import RecordSink
 from ..converters import zotero
 
 
 class ShallowVandAInformation(object):
+    __slots__ = ('__item_id', '__tag')
+
     def __init__(self, item_id: str, tag: str):
         self.__item_id = item_id
         self.__tag = tag
@@ -37,6 +43,8 @@ class ShallowVandAInformation(object):
 
 
 class DeepVandAInformation(ShallowVandAInformation):
+    __slots__ = ('__image_urls', '__verbose', '__image_names', '__image_variants')
+
     def __init__(self,
                  shallow: ShallowVandAInformation,
                  image_urls: List[str],
@@ -45,6 +53,7 @@ class DeepVandAInformation(ShallowVandAInformation):
         self.__image_urls = image_urls
         self.__verbose = verbose
         self.__image_names = []
+        self.__image_variants = []
 
     @property
     def image_urls(self):
@@ -58,6 +67,13 @@ class DeepVandAInformation(ShallowVandAInformation):
     def image_names(self):
         return self.__image_names
 
+    @property
+    def image_variants(self):
+        """
+        For every image in image_names, the files of its variants by variant name
+        """
+        return self.__image_variants
+
     def to_dict(self):
         d = super(DeepVandAInformation, self).to_dict()
         d.update({
@@ -81,9 +97,10 @@ class VandA(Scraper):
         ";"
     ]
 
-    __OBJECT_ID_PATTERN = r'item/(?P<objectId>O[0-9]+)'
+    __OBJECT_ID_PATTERN = re.compile(r'item/(?P<objectId>O[0-9]+)')
 
-    def __init__(self):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.__logger = logging.getLogger(self.__class__.__name__)
 
     @property
@@ -114,90 +131,228 @@ class VandA(Scraper):
         self._prepare_output(output=kwargs['output'], overwrite=kwargs['overwrite'])
         self._log.info("Output folder prepared: %s", kwargs['output'])
 
-        df = self._load_csv(kwargs['input_file'])
+        concurrency = max(1, int(kwargs.get('concurrency', 1)))
+        self._log.info("Will call API and download images for each element (concurrency: %s)", concurrency)
+
+        output = kwargs['output']
+        annotation_file = os.path.join(output, 'vanda_scraped.csv')
+        objects = self.__read_input(kwargs['input_file'], kwargs.get('shard'))
+        manifest = None
+        row_index = 0
+        if kwargs.get('delta', False):
+            # only the objects without rows in the annotation csv are processed, the csv is appended to
+            manifest = self._open_manifest(output)
+            objects, row_index = self._apply_delta(manifest, objects, annotation_file, 'item_id', renumber=True,
+                                                   **kwargs)
+
+        number_of_items = 0
+        scheduler = self._retry_scheduler(output)
+        with self._open_journal(output) as journal, self._open_sink("vanda", **kwargs) as records, \
+                open(annotation_file, 'w' if manifest is None else 'a', newline='') as fo:
+            writer = csv.writer(fo, lineterminator='\n')
+            if fo.tell() == 0:
+                writer.writerow(['', 'item_id', 'tag', 'image_path'] +
+                                [f"image_path_{v.name}" for v in self._image_variants])
+            items = (ShallowVandAInformation(item_id=o.object_id, tag=o.tag) for o in objects)
+            lookup_batch = max(1, int(kwargs.get('lookup_batch', 1)))
+            if lookup_batch > 1:
+                # one search request looks up the fields of lookup_batch elements ahead of the item stage
+                batches = iter(lambda: list(itertools.islice(items, lookup_batch)), [])
+                looked_up = (x for batch in self._bounded_map(lambda b: self.__lookup_batch(b, journal), batches,
+                                                              -(-concurrency // lookup_batch))
+                             for x in batch)
+            else:
+                looked_up = ((source, None) for source in items)
+            for d in self._bounded_map(lambda x: self.__process_item(x[0], output, journal, records, x[1]),
+                                       looked_up,
+                                       concurrency,
+                                       scheduler=scheduler,
+                                       on_failure=lambda x, e, tries: scheduler.dead_letter(x[0].item_id, e, tries)):
+                number_of_items += 1
+                for ip, variant_files in zip(d.image_names, d.image_variants):
+                    writer.writerow([row_index, d.item_id, d.tag, ip] +
+                                    [variant_files.get(v.name, "") for v in self._image_variants])
+                    row_index += 1
+                fo.flush()
+
+        scheduler.close()
+        if manifest is not None:
+            manifest.commit()
+        self._log.info("Processed %s item ids", number_of_items)
 
-        data: List[ShallowVandAInformation] = []
+    def _check_input(self, **kwargs) -> bool:
+        return super(VandA, self)._check_input(kwargs) and all(x in kwargs for x in self.__special_input)
 
-        for _, row in df.iterrows():
-            import_data: zotero.ZoteroData = zotero.parse_row(row, self.__OBJECT_ID_PATTERN)
-            if any(x in import_data.tag for x in self.__IGNORED_TAGS):
+    def __read_input(self, input_file: str,
+                     shard: Optional[Tuple[int, int]] = None) -> Iterator[zotero.ZoteroData]:
+        """
+        Lazily reads the elements of the Zotero export, skipping ignored tags and duplicated ids.
+
+        :param input_file: the csv file as exported by Zotero
+        :param shard: (i, N) to read only the elements of worker i of N
+        :return: the elements in the order of the export
+        """
+        for chunk in zotero.read_csv(input_file, self.__OBJECT_ID_PATTERN, ignored_tags=self.__IGNORED_TAGS):
+            for import_data in chunk:
+                if not self._in_shard(import_data.object_id, shard):
+                    continue
+                self._log.debug("Item ID: %s", import_data.object_id)
+                yield import_data
+
+    def __process_item(self, source: ShallowVandAInformation, output: str, journal: Journal,
+                       records: RecordSink, fields: Optional[Dict] = None) -> DeepVandAInformation:
+        """
+        Calls the API for one element, unless its fields were looked up in a batch, writes its record
+        and downloads its images.
+        Runs inside a worker thread, so several elements are in flight at the same time.
+        Elements that are finished according to the journal are loaded from their json file instead,
+        or, if the records are not written to json files, from the files the sink stored or the images in the
+        output folder.
+
+        :param source: the element to process
+        :param output: output folder where all results are saved
+        :param journal: journal of the output folder
+        :param records: sink the record of the element is written to
+        :param fields: the API fields of the element if they were looked up already
+        :return: the element with the API information and the names of the downloaded images
+        """
+        json_file = os.path.join(output, f"{source.item_id}.json")
+        # (idx, image file, variants in progress) of every image of the element
+        processing = []
+
+        has_record = records.has_record(journal, source.item_id)
+        if (source.item_id in journal or has_record) and os.path.isfile(json_file):
+            # the images of elements that failed in an earlier run are downloaded again from the urls of the record
+            self._log.debug("'%s' already has a record, reading the image urls from it", source.item_id)
+            with open(json_file, 'r') as fi:
+                d = DeepVandAInformation(shallow=source, image_urls=json.load(fi)['image_urls'], verbose={})
+        elif source.item_id in journal:
+            self._log.debug("'%s' already finished, skipping", source.item_id)
+            d = DeepVandAInformation(shallow=source, image_urls=[], verbose={})
+            stored_files = records.stored_files(d.item_id)
+            if stored_files is not None:
+                self.__set_stored_images(d, stored_files)
+                return d
+            for idx in itertools.count():
+                target_file = os.path.join(output, f"{d.item_id}_{idx}{self.__IMAGE_SUFFIX}")
+                if not os.path.isfile(target_file):
+                    break
+                d.image_names.append(target_file)
+                processing.append((idx, target_file, self._process_image(target_file)))
+            for _, target_file, future in processing:
+                d.image_variants.append(self._variant_files(target_file, future))
+            return d
+        else:
+            d = self.__call_api(source) if fields is None else self.__to_information(source, fields)
+
+            # the record of an element that failed in an earlier run is written already, only its images are missing
+            if not has_record:
+                with self.metrics.time("write"):
+                    records.write(d.item_id, d.to_dict())
+                records.mark(journal, d.item_id, Journal.METADATA)
+
+        failed = False
+        for idx, image_url in enumerate(d.image_urls):
+            target_file = os.path.join(output, f"{d.item_id}_{idx}{self.__IMAGE_SUFFIX}")
+
+            self._log.info(f"Will download image {idx + 1}/{len(d.image_urls)} for '{d.item_id}'")
+            if os.path.isfile(target_file):
+                self._log.debug("Already exists, skipping")
+            elif not self._download_image(image_url=image_url, target_file=target_file):
+                self._log.warning("Could not download this file.")
+                failed = True
                 continue
-            if import_data.object_id in [j.item_id for j in data]:
-                self._log.debug("Duplicated object id: '%s'", import_data.object_id)
-                continue
-            data.append(
-                ShallowVandAInformation(
-                    item_id=import_data.object_id,
-                    tag=import_data.tag
-                )
-            )
-
-        self._log.info("Found %s item ids", len(data))
-        if self._log.isEnabledFor(logging.DEBUG):
-            self._log.debug("Item IDs: \n%s", "\n".join(str(x) for x in data))
-
-        self._log.info("Will call API for each element to get images and additional information")
-        deep_data: List[DeepVandAInformation] = [
-            self.__call_api(d) for d in data
-        ]
-
-        self._log.info("Saving json files")
-        for d in deep_data:
-            with open(os.path.join(kwargs['output'], f"{d.item_id}.json"), 'w') as fo:
-                json.dump(d.to_dict(), fo, indent=2)
-
-        self._log.info("Downloading images")
-        for d in deep_data:
-            for idx, image_url in enumerate(d.image_urls):
-                target_file = os.path.join(kwargs['output'], f"{d.item_id}_{idx}{self.__IMAGE_SUFFIX}")
-
-                self._log.info(f"Will download image {idx + 1}/{len(d.image_urls)} for '{d.item_id}'")
-                if os.path.isfile(target_file):
-                    self._log.debug("Already exists, skipping")
-                else:
-                    if self._download_image(
-                            image_url=image_url,
-                            target_file=target_file
-                    ):
-                        d.image_names.append(target_file)
-                    else:
-                        self._log.warning("Could not download this file.")
-
-        _item_ids = []
-        _tags = []
-        _image_paths = []
-
-        for d in deep_data:
-            for ip in d.image_names:
-                _item_ids.append(d.item_id)
-                _tags.append(d.tag)
-                _image_paths.append(ip)
-
-        df = pd.DataFrame(
-            {
-                'item_id': _item_ids,
-                'tag': _tags,
-                'image_path': _image_paths
-            }
-        )
-
-        df.to_csv(os.path.join(kwargs['output'], 'vanda_scraped.csv'))
+            d.image_names.append(target_file)
+            # the variants of this image are made while the next one is downloaded
+            processing.append((idx, target_file, self._process_image(target_file)))
+
+        image_files = {}
+        for idx, target_file, future in processing:
+            variant_files = self._variant_files(target_file, future)
+            d.image_variants.append(variant_files)
+            image_files[f"{idx}{self.__IMAGE_SUFFIX}"] = target_file
+            for variant in self._image_variants:
+                if variant.name in variant_files:
+                    image_files[f"{idx}{variant.suffix}"] = variant_files[variant.name]
+
+        if not failed:
+            records.add_files(d.item_id, image_files)
+            stored_files = records.stored_files(d.item_id)
+            if stored_files is not None:
+                self.__set_stored_images(d, stored_files)
+        records.mark(journal, d.item_id, Journal.FAILED if failed else Journal.IMAGE)
 
-    def _check_input(self, **kwargs) -> bool:
-        return super(VandA, self)._check_input(kwargs) and all(x in kwargs for x in self.__special_input)
+        return d
+
+    def __set_stored_images(self, d: DeepVandAInformation, stored_files: List[str]):
+        """
+        Sets the images and their variants of an element to the files the record sink stored for it.
+        """
+        stored = set(stored_files)
+        d.image_names[:] = [f for f in stored_files if f.endswith(self.__IMAGE_SUFFIX)
+                            and not any(f.endswith(v.suffix) for v in self._image_variants)]
+        d.image_variants[:] = [{v.name: v.file(f) for v in self._image_variants if v.file(f) in stored}
+                               for f in d.image_names]
 
     def __call_api(self, source: ShallowVandAInformation) -> DeepVandAInformation:
-        req = requests.get(f"{self.__API_URL}/{source.item_id}")
+        req = self._get(f"{self.__API_URL}/{source.item_id}")
 
         if not req.ok:
-            raise InterruptedError(req.status_code)
+            raise FetchError.from_response(req)
 
-        data = req.json()
+        with self.metrics.time("parse"):
+            data = req.json()
         assert len(data) == 1
         data = data[0]['fields']
 
         assert data['object_number'] == source.item_id
 
+        return self.__to_information(source, data)
+
+    def __lookup_batch(self, batch: List[ShallowVandAInformation],
+                       journal: Journal) -> List[Tuple[ShallowVandAInformation, Optional[Dict]]]:
+        """
+        Looks up the API fields of the unfinished elements of a batch with one search request.
+        Elements the search does not return in full are called one by one by the item stage,
+        as are all of them if the search fails.
+
+        :param batch: consecutive elements of the input
+        :param journal: journal of the output folder
+        :return: every element of the batch with its fields, None if it has to be called on its own
+        """
+        pending = [s.item_id for s in batch if s.item_id not in journal]
+        found = {}
+        if len(pending) > 1:
+            try:
+                found = self.__search(pending)
+            except Exception as e:
+                self._log.warning("Batch lookup of %s items failed, calling them one by one: %s", len(pending), e)
+        for item_id in pending:
+            self.metrics.inc("batch_lookups_total", result="hit" if item_id in found else "miss")
+        return [(s, found.get(s.item_id)) for s in batch]
+
+    def __search(self, item_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Searches the API for several object numbers at once.
+
+        :return: the fields of the found objects that have all fields a single call returns, by object number
+        """
+        req = self._get(f"{self.__API_URL}/search?" + urlencode({'q': " OR ".join(item_ids), 'limit': len(item_ids)}))
+
+        if not req.ok:
+            raise FetchError.from_response(req)
+
+        with self.metrics.time("parse"):
+            data = req.json()
+        wanted = set(item_ids)
+        found = {}
+        for record in (data['records'] if isinstance(data, dict) else data):
+            fields = record.get('fields', {})
+            if fields.get('object_number') in wanted and 'primary_image_id' in fields and 'image_set' in fields:
+                found[fields['object_number']] = fields
+        return found
+
+    def __to_information(self, source: ShallowVandAInformation, data: Dict) -> DeepVandAInformation:
         image_ids = [data['primary_image_id']]
         image_ids.extend([
             x['fields']['image_id'] for x in data['image_set'] if x['fields']['image_id'] not in image_ids
@@ -1,18 +1,27 @@
-import json
+import csv
 import logging
 import os
 import re
-from typing import Optional, List
+from typing import TYPE_CHECKING, Dict, Optional, Iterator, Tuple
 
-import pandas as pd
-import requests
-from lxml import html
+from lxml import etree, html
 
 from . import Scraper
-from ..converters.zotero import ZoteroData, parse_row
+from ..journal import Journal
+from ..retry import FetchError
+from ..sinks import RecordSink
+from ..converters.zotero import ZoteroData, read_csv
+from ..delta import annotated_objects
+
+if TYPE_CHECKING:
+    from requests.cookies import RequestsCookieJar
 
 
 class WallaceCollectionInformation(object):
+    __slots__ = ('__object_id', '__object_name', '__title', '__reference', '__reference_data', '__place_artist',
+                 '__dates_all', '__material', '__dimensions', '__marks', '__museum_number', '__commentary',
+                 '__image_url', '__tag', '__variant_names')
+
     def __init__(self, object_id: str, object_name: str, title: str, reference: str, reference_data: str,
                  place_artist: str, dates_all: str, material: str, dimensions: str, marks: str, museum_number: str,
                  commentary: str, image_url: Optional[str] = None):
@@ -30,6 +39,7 @@ class WallaceCollectionInformation(object):
         self.__commentary = commentary
         self.__image_url = image_url
         self.__tag = None
+        self.__variant_names = {}
 
     @property
     def object_id(self):
@@ -99,6 +109,17 @@ class WallaceCollectionInformation(object):
     def tag(self, tag):
         self.__tag = tag
 
+    @property
+    def variant_names(self):
+        """
+        The file names of the variants of the image by variant name
+        """
+        return self.__variant_names
+
+    @variant_names.setter
+    def variant_names(self, variant_names):
+        self.__variant_names = variant_names
+
     def to_dict(self):
         return {
             'object_id': self.object_id,
@@ -128,24 +149,22 @@ class WallaceCollection(Scraper):
     __URL_PREFIX = "http://wallacelive.wallacecollection.org"
     __URL_TEMPLATE = "/eMuseumPlus?service=ExternalInterface&module=collection&viewType=detailView&objectId="
 
-    __URL_OBJECT_ID = r"objectId=(?P<objectId>[0-9]+)"
-
-    __XPATH = {
-        'object_name': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[1]/span[1]/text()',
-        'title': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[2]/span[1]/text()',
-        'reference': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[3]/span/span/a/span/text()',
-        'reference_data': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[4]/span[1]/text()',
-        'place_artist': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[5]/span[1]/text()',
-        'dates_all': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[6]/span[1]/text()',
-        'material': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[7]/span[1]/text()',
-        'dimensions': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[8]/span[1]/text()',
-        'marks': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[9]/span[1]/text()',
-        'museum_number': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dd[1]/ul[1]/li[10]/span[1]/text()',
-        'commentary': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[2]/dd/div/ul/li/span[1]/text()',
-        'image_url': '/html/body/div[1]/div[4]/div[2]/div[2]/dl[1]/dt[1]/a/@href'
-    }
-
-    def __init__(self):
+    __URL_OBJECT_ID = re.compile(r"objectId=(?P<objectId>[0-9]+)")
+
+    # the fields are compiled once and evaluated relative to the record, the list items are walked in one pass
+    __XPATH_RECORD = etree.XPath('/html/body/div[1]/div[4]/div[2]/div[2]')
+    __XPATH_LIST_ITEMS = etree.XPath('dl[1]/dd[1]/ul[1]/li')
+    __XPATH_VALUE = etree.XPath('span[1]/text()')
+    __XPATH_REFERENCE = etree.XPath('span/span/a/span/text()')
+    __XPATH_COMMENTARY = etree.XPath('dl[2]/dd/div/ul/li/span[1]/text()')
+    __XPATH_IMAGE_URL = etree.XPath('dl[1]/dt[1]/a/@href')
+    __XPATH_POPUP_IMAGE = etree.XPath('/html/body/div/table/tr/td/img/@src')
+
+    __LIST_FIELDS = ('object_name', 'title', 'reference', 'reference_data', 'place_artist', 'dates_all', 'material',
+                     'dimensions', 'marks', 'museum_number')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.__logger = logging.getLogger(__name__)
 
     @property
@@ -155,72 +174,156 @@ class WallaceCollection(Scraper):
     def scrape(self, **kwargs):
         self._log.debug("Called scrape with options: %s", kwargs)
 
-        objects: List[ZoteroData] = [
-            parse_row(row, self.__URL_OBJECT_ID)
-            for _, row in pd.read_csv(kwargs['input_file']).iterrows()
-        ]
-
-        download_progress_file = os.path.join(kwargs['output'], "downloaded.txt")
-
-        if os.path.isfile(download_progress_file):
-            with open(download_progress_file, 'r') as fi:
-                download_progress = list(set([l.strip() for l in fi]))
-        else:
-            download_progress = []
-
-        annotations = []
-
-        for obj in [o for o in objects if o.object_id not in download_progress]:
-            annotation: Optional[WallaceCollectionInformation] = self.__extract_page(obj, kwargs['output'])
-            if annotation is None:
-                self._log.error(f"Object '{obj.object_id}' could not be downloaded")
-                continue
-            annotations.append(annotation)
-            download_progress.append(obj.object_id)
-            with open(download_progress_file, 'w') as fo:
-                fo.write("\n".join(download_progress))
-
-        df = pd.DataFrame(
-            [a.to_dict() for a in annotations],
-            index=[o.object_id for o in objects],
-            columns=['object_id', 'tag', 'image_name'])
-
-        df.to_csv(os.path.join(kwargs['output'], "wallace_annotation.csv"))
-
-    def __extract_page(self, obj: ZoteroData, output) -> Optional[WallaceCollectionInformation]:
+        def read_objects() -> Iterator[ZoteroData]:
+            return (obj for chunk in read_csv(kwargs['input_file'], self.__URL_OBJECT_ID) for obj in chunk
+                    if self._in_shard(obj.object_id, kwargs.get('shard')))
+
+        objects = read_objects()
+
+        output = kwargs['output']
+        annotation_file = os.path.join(output, "wallace_annotation.csv")
+        manifest = None
+        if kwargs.get('delta', False):
+            # only the objects without rows in the annotation csv are processed
+            manifest = self._open_manifest(output)
+            objects, _ = self._apply_delta(manifest, objects, annotation_file, 'object_id', **kwargs)
+
+        concurrency = max(1, kwargs.get('concurrency', 1))
+        scheduler = self._retry_scheduler(output)
+
+        def give_up(object_id: str, error: Exception, tries: int):
+            self._log.error(f"Object '{object_id}' could not be downloaded")
+            journal.mark(object_id, Journal.FAILED)
+            scheduler.dead_letter(object_id, error, tries)
+
+        with self._open_journal(output) as journal, self._open_sink("wallace", **kwargs) as records, \
+                open(annotation_file, 'a', newline='') as fo:
+            # the rows of earlier runs are kept, the csv is appended to
+            annotated = annotated_objects(annotation_file, 'object_id')
+            writer = csv.writer(fo, lineterminator='\n')
+            if fo.tell() == 0:
+                writer.writerow(['', 'object_id', 'tag', 'image_name'] +
+                                [f"image_name_{v.name}" for v in self._image_variants])
+            # finished objects without a row (e.g. of an interrupted run) get it back without fetching
+            for obj in (objects if manifest is not None else read_objects()):
+                if obj.object_id in journal and obj.object_id not in annotated:
+                    writer.writerow([obj.object_id, obj.object_id, obj.tag] +
+                                    self._restored_images(output, records, obj.object_id, f"{obj.object_id}.jpg"))
+            fo.flush()
+            # page -> popup and the image download run as two pipelined stages, each with up to concurrency
+            # objects in flight; the popup cookies travel with the object to its image request
+            pages = self._bounded_map(lambda o: self.__extract_page(o, journal, records),
+                                      (o for o in objects if o.object_id not in journal),
+                                      concurrency,
+                                      scheduler=scheduler,
+                                      on_failure=lambda o, e, t: give_up(o.object_id, e, t))
+            for annotation in self._bounded_map(lambda p: self.__extract_image(p, output, records),
+                                                pages,
+                                                concurrency,
+                                                scheduler=scheduler,
+                                                on_failure=lambda p, e, t: give_up(p[0].object_id, e, t)):
+                if annotation.object_id not in annotated:
+                    # with a tar backend, the files are only in the shard, under the names it stored them
+                    images = self._stored_images(records, annotation.object_id, self._image_variants)
+                    if images is None:
+                        images = [annotation.image_name] + [annotation.variant_names.get(v.name, "")
+                                                            for v in self._image_variants]
+                    writer.writerow([annotation.object_id, annotation.object_id, annotation.tag] + images)
+                    fo.flush()
+                records.mark(journal, annotation.object_id, Journal.IMAGE)
+        scheduler.close()
+        if manifest is not None:
+            manifest.commit()
+
+    def __extract_page(self, obj: ZoteroData, journal: Journal,
+                       records: RecordSink) -> Tuple[WallaceCollectionInformation, 'RequestsCookieJar']:
+        """
+        Scrapes the detail page and the image popup of an object.
+
+        :return: the information of the object and the cookies of the popup, which the image request needs
+        :raises FetchError: if the page or the popup could not be fetched
+        """
         self._log.debug("Will scrape object_id '%s'", obj.object_id)
-        page = requests.get(
-            f"{self.__URL_PREFIX}{self.__URL_TEMPLATE}{obj.object_id}",
-            cookies={}
-        )
-
-        if page.ok:
-            html_page = html.fromstring(page.text)
-
-            values = {}
-            for xpath_key, xpath_string in self.__XPATH.items():
-                xpath = html_page.xpath(xpath_string)
-                values[xpath_key] = xpath[0] if len(xpath) > 0 else ""
-
-            info = WallaceCollectionInformation(object_id=obj.object_id, **values)
-            info.tag = obj.tag
-
-            image_popup = requests.get(self.__URL_PREFIX + re.findall(r"(/eMuseumPlus.*=F)", values['image_url'])[0],
-                                       cookies=page.cookies)
-            if image_popup.ok:
-                info.image_url = self.__URL_PREFIX + html.fromstring(image_popup.text) \
-                    .xpath("/html/body/div/table/tr/td/img/@src")[0]
-
-                with open(os.path.join(output, f"{info.object_id}.json"), 'w') as fo:
-                    json.dump(info.to_dict(), fo, indent=2)
-
-                target_image = os.path.join(output, f"{info.object_id}.jpg")
-                if not os.path.isfile(target_image):
-                    WallaceCollection._download_image(image_url=info.image_url,
-                                                      target_file=target_image,
-                                                      cookies=image_popup.cookies)
-
-                return info
+        page = self._get(f"{self.__URL_PREFIX}{self.__URL_TEMPLATE}{obj.object_id}")
+        if not page.ok:
+            raise FetchError.from_response(page)
+
+        with self.metrics.time("parse"):
+            values = self._parse_page(page.text)
+
+        info = WallaceCollectionInformation(object_id=obj.object_id, **values)
+        info.tag = obj.tag
+
+        image_popup = self._get(self.__URL_PREFIX + re.findall(r"(/eMuseumPlus.*=F)", values['image_url'])[0],
+                                cookies=page.cookies)
+        if not image_popup.ok:
+            raise FetchError.from_response(image_popup)
+
+        with self.metrics.time("parse"):
+            info.image_url = self.__URL_PREFIX + self.__XPATH_POPUP_IMAGE(html.fromstring(image_popup.text))[0]
+
+        # the record of an object whose image failed in an earlier run is written already
+        if not records.has_record(journal, info.object_id):
+            with self.metrics.time("write"):
+                records.write(info.object_id, info.to_dict())
+            records.mark(journal, info.object_id, Journal.METADATA)
+
+        return info, image_popup.cookies
+
+    def __extract_image(self, page: Tuple[WallaceCollectionInformation, 'RequestsCookieJar'],
+                        output, records: RecordSink) -> WallaceCollectionInformation:
+        """
+        Downloads the image of an object with the cookies of its popup, makes its variants and hands them
+        to the record sink.
+
+        :raises FetchError: if the image could not be downloaded
+        """
+        info, cookies = page
+        target_image = os.path.join(output, f"{info.object_id}.jpg")
+        if not os.path.isfile(target_image):
+            if not self._download_image(image_url=info.image_url,
+                                        target_file=target_image,
+                                        cookies=cookies):
+                raise FetchError(info.image_url)
+
+        variant_files = self._variant_files(target_image, self._process_image(target_image))
+        info.variant_names = {name: os.path.basename(file) for name, file in variant_files.items()}
+        files = {"jpg": target_image}
+        files.update((v.suffix[1:], variant_files[v.name]) for v in self._image_variants if v.name in variant_files)
+        records.add_files(info.object_id, files)
+
+        return info
+
+    @classmethod
+    def _parse_page(cls, text: str) -> Dict[str, str]:
+        """
+        Extracts the fields of a detail page, a field that is not on the page is "".
+        """
+        return cls._extract_fields(html.fromstring(text))
+
+    @classmethod
+    def _extract_fields(cls, page) -> Dict[str, str]:
+        """
+        Extracts the fields of the parsed html tree of a detail page, a field that is not on the page is "".
+        """
+        values = {key: "" for key in cls.__LIST_FIELDS + ('commentary', 'image_url')}
+
+        record = cls.__XPATH_RECORD(page)
+        if len(record) == 0:
+            return values
+        record = record[0]
+
+        for key, li in zip(cls.__LIST_FIELDS, cls.__XPATH_LIST_ITEMS(record)):
+            found = cls.__XPATH_REFERENCE(li) if key == 'reference' else cls.__XPATH_VALUE(li)
+            if len(found) > 0:
+                values[key] = str(found[0])
+
+        for key, xpath in (('commentary', cls.__XPATH_COMMENTARY), ('image_url', cls.__XPATH_IMAGE_URL)):
+            found = xpath(record)
+            if len(found) > 0:
+                values[key] = str(found[0])
+
+        return values
 
     @staticmethod
     def _extract_object_ids(input_file):
@@ -0,0 +1,150 @@
+import io
+import json
+import logging
+import os
+import re
+import sys
+import tarfile
+import time
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from .sinks import RecordSink
+
+if TYPE_CHECKING:
+    from .journal import Journal
+
+_log = logging.getLogger(__name__)
+
+
+class TarShardSink(RecordSink):
+    """
+    Writes every object as one sample of WebDataset style tar shards: its record as "<key>.json" followed by its
+    files, e.g. "<key>.jpg" or "<key>.0.jpg", "<key>.1.jpg". The key is the record id without dots, as the
+    readers take everything after the first dot of a name as extension.
+
+    The shards "shard-000000.tar", "shard-000001.tar", ... are written one after the other; a new one is
+    started when the next sample would make the current one bigger than shard_size bytes. A later run starts
+    a new shard. "index.jsonl" lists for every sample its shard and the offset and size of each of its files
+    within the shard, so single samples can be read without scanning the shards.
+
+    A record is written together with the files passed to add_files for it, and the files are removed from
+    the output folder afterwards. Records that never get files (e.g. because the image failed) are written
+    on their own when the sink is closed.
+    """
+
+    __KEY_PATTERN = re.compile(r"[.\s/\\]")
+
+    def __init__(self, directory: str, shard_size: int = 1024 ** 3):
+        self.__directory = directory
+        self.__shard_size = shard_size
+        self.__lock = Lock()
+        self.__pending: Dict[str, Dict] = {}
+        # the extensions of the stored files of every record, e.g. ("json", "jpg"), the names are "<key>.<extension>"
+        self.__stored: Dict[str, Tuple[str, ...]] = {}
+        self.__tar: Optional[tarfile.TarFile] = None
+        self.__shard = None
+
+        os.makedirs(directory, exist_ok=True)
+        index_file = os.path.join(directory, "index.jsonl")
+        if os.path.isfile(index_file):
+            with open(index_file, 'r', encoding='utf-8') as fi:
+                for line in fi:
+                    if line.endswith("\n"):
+                        entry = json.loads(line)
+                        self.__stored[sys.intern(entry['id'])] = self.__extensions(entry)
+        self.__index = open(index_file, 'a', encoding='utf-8')
+
+        self.__next_shard = 0
+        for name in os.listdir(directory):
+            match = re.fullmatch(r"shard-(\d+)\.tar", name)
+            if match:
+                self.__next_shard = max(self.__next_shard, int(match.group(1)) + 1)
+
+    @classmethod
+    def key(cls, record_id: str) -> str:
+        return cls.__KEY_PATTERN.sub("_", record_id)
+
+    def write(self, record_id: str, record: Dict):
+        with self.__lock:
+            self.__pending[record_id] = record
+
+    def add_files(self, record_id: str, files: Dict[str, str]):
+        with self.__lock:
+            record = self.__pending.pop(record_id, None)
+            self.__write_sample(record_id, record, files)
+        for file in files.values():
+            os.remove(file)
+
+    def stored_files(self, record_id: str) -> Optional[List[str]]:
+        with self.__lock:
+            extensions = self.__stored.get(record_id)
+        if extensions is None:
+            return None
+        key = self.key(record_id)
+        return [f"{key}.{extension}" for extension in extensions]
+
+    def has_record(self, journal: 'Journal', record_id: str) -> bool:
+        # the record only gets into a shard together with its files, whatever the journal says
+        with self.__lock:
+            return record_id in self.__pending or 'json' in self.__stored.get(record_id, ())
+
+    @staticmethod
+    def __extensions(entry: Dict) -> Tuple[str, ...]:
+        # records have the same few extensions, so they are shared between them
+        return tuple(sys.intern(f['name'][len(entry['key']) + 1:]) for f in entry['files'])
+
+    def __write_sample(self, record_id: str, record: Optional[Dict], files: Dict[str, str]):
+        key = self.key(record_id)
+        members = []
+        if record is not None:
+            members.append((f"{key}.json", json.dumps(record, ensure_ascii=False).encode('utf-8'), None))
+        for extension, file in files.items():
+            members.append((f"{key}.{extension}", None, file))
+
+        # every member needs a 512 byte header (more for long names) and is padded to a multiple of 512 bytes
+        size = sum(512 + -(-(len(data) if data is not None else os.path.getsize(file)) // 512) * 512
+                   for _, data, file in members)
+        if self.__tar is not None and self.__tar.offset + size > self.__shard_size:
+            self.__close_shard()
+        if self.__tar is None:
+            self.__open_shard()
+
+        entry = {'id': record_id, 'key': key, 'shard': self.__shard, 'files': []}
+        for name, data, file in members:
+            info = tarfile.TarInfo(name)
+            info.mtime = int(time.time())
+            if data is not None:
+                info.size = len(data)
+                self.__tar.addfile(info, io.BytesIO(data))
+            else:
+                info.size = os.path.getsize(file)
+                with open(file, 'rb') as fi:
+                    self.__tar.addfile(info, fi)
+            # the data ends, padded, at the current end of the shard
+            offset = self.__tar.offset - -(-info.size // 512) * 512
+            entry['files'].append({'name': name, 'offset': offset, 'size': info.size})
+        self.__tar.fileobj.flush()
+
+        self.__index.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.__index.flush()
+        self.__stored[record_id] = self.__extensions(entry)
+
+    def __open_shard(self):
+        self.__shard = f"shard-{self.__next_shard:06d}.tar"
+        self.__next_shard += 1
+        self.__tar = tarfile.open(os.path.join(self.__directory, self.__shard), 'w')
+        _log.info("Writing shard '%s'", self.__shard)
+
+    def __close_shard(self):
+        self.__tar.close()
+        self.__tar = None
+
+    def close(self):
+        with self.__lock:
+            for record_id, record in self.__pending.items():
+                self.__write_sample(record_id, record, {})
+            self.__pending = {}
+            if self.__tar is not None:
+                self.__close_shard()
+            self.__index.close()
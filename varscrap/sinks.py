@@ -0,0 +1,235 @@
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from .journal import Journal
+
+_log = logging.getLogger(__name__)
+
+FORMATS = ('json', 'jsonl', 'jsonl.gz', 'jsonl.bz2', 'jsonl.xz', 'parquet')
+BACKENDS = ('files', 'tar')
+
+
+class RecordSink(ABC):
+    """
+    Where the metadata record of every scraped object is written to.
+    Records may be written from several threads at the same time.
+    """
+
+    @abstractmethod
+    def write(self, record_id: str, record: Dict):
+        pass
+
+    def add_files(self, record_id: str, files: Dict[str, str]):
+        """
+        Hands over the downloaded files of a record, by their extension, e.g. {"jpg": "/out/1.jpg"}.
+        Sinks that leave the files in the output folder ignore them.
+        """
+        pass
+
+    def stored_files(self, record_id: str) -> Optional[List[str]]:
+        """
+        :return: the names of the files the sink stored for a record or None if it does not keep track of them
+        """
+        return None
+
+    def mark(self, journal: 'Journal', record_id: str, stage: str):
+        """
+        Marks a stage of a record as finished in journal once the record is written for good,
+        right away for sinks that write every record when it is passed to write.
+        """
+        journal.mark(record_id, stage)
+
+    def has_record(self, journal: 'Journal', record_id: str) -> bool:
+        """
+        :return: whether the record was written already, in this run or, as recorded in journal, in an earlier one
+        """
+        from .journal import Journal
+
+        return journal.is_done(record_id, Journal.METADATA)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JsonFileSink(RecordSink):
+    """
+    Writes every record to its own "<record_id>.json" file in the output folder.
+    """
+
+    def __init__(self, output: str):
+        self.__output = output
+
+    def write(self, record_id: str, record: Dict):
+        with open(os.path.join(self.__output, f"{record_id}.json"), 'w') as fo:
+            json.dump(record, fo, indent=2)
+
+
+class BatchedSink(RecordSink):
+    """
+    A sink that writes the records in batches of batch_size, the last batch when it is closed.
+    The journal marks of a record are held back until its batch is written, so a killed process only loses
+    records that the journal does not count as finished and a resumed run scrapes them again.
+    """
+
+    def __init__(self, batch_size: int = 1000):
+        self.__batch_size = batch_size
+        self.__batch: List = []
+        self.__batch_ids: Set[str] = set()
+        self.__marks: List[Tuple['Journal', str, str]] = []
+        self.__lock = Lock()
+
+    @abstractmethod
+    def _prepare(self, record: Dict):
+        """
+        :return: what is kept of a record until its batch is written
+        """
+        pass
+
+    @abstractmethod
+    def _write_batch(self, batch: List):
+        pass
+
+    def write(self, record_id: str, record: Dict):
+        prepared = self._prepare(record)
+        with self.__lock:
+            self.__batch.append(prepared)
+            self.__batch_ids.add(record_id)
+            if len(self.__batch) >= self.__batch_size:
+                self.__flush()
+
+    def mark(self, journal: 'Journal', record_id: str, stage: str):
+        with self.__lock:
+            if record_id in self.__batch_ids:
+                self.__marks.append((journal, record_id, stage))
+                return
+        journal.mark(record_id, stage)
+
+    def has_record(self, journal: 'Journal', record_id: str) -> bool:
+        # the marks of the records in the batch are held back, so the journal does not know of them yet
+        with self.__lock:
+            if record_id in self.__batch_ids:
+                return True
+        return super().has_record(journal, record_id)
+
+    def __flush(self):
+        if self.__batch:
+            self._write_batch(self.__batch)
+        self.__batch = []
+        self.__batch_ids = set()
+        marks, self.__marks = self.__marks, []
+        for journal, record_id, stage in marks:
+            journal.mark(record_id, stage)
+
+    def close(self):
+        with self.__lock:
+            self.__flush()
+
+
+class JsonLinesSink(BatchedSink):
+    """
+    Appends the records to one JSON Lines file, compressed if the file name ends with .gz, .bz2 or .xz.
+    Records are written in batches of batch_size lines; a later run appends to the same file
+    (for compressed files as a new stream, which the usual tools read as one file).
+    """
+
+    __OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+    def __init__(self, file: str, batch_size: int = 1000):
+        super().__init__(batch_size)
+        self.__file = file
+        self.__open = self.__OPENERS.get(os.path.splitext(file)[1], open)
+
+    def _prepare(self, record: Dict) -> str:
+        return json.dumps(record, ensure_ascii=False) + "\n"
+
+    def _write_batch(self, batch: List[str]):
+        with self.__open(self.__file, 'at', encoding='utf-8') as fo:
+            fo.writelines(batch)
+
+
+class ParquetSink(BatchedSink):
+    """
+    Writes the records to Parquet files, one complete file per batch of batch_size records:
+    "<name>.parquet", "<name>.1.parquet", "<name>.2.parquet" and so on, numbered on by later runs.
+    A file only gets its name once it is complete, so a killed process never leaves a file without footer.
+    The columns are the keys of the first batch; nested values (lists and dicts) are stored as json strings.
+    Needs pyarrow.
+    """
+
+    def __init__(self, file: str, batch_size: int = 1000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Writing Parquet needs pyarrow: pip install pyarrow") from e
+        super().__init__(batch_size)
+        self.__pa = pyarrow
+        self.__pq = pyarrow.parquet
+
+        self.__base, self.__ext = os.path.splitext(file)
+        self.__number = 0
+        self.__schema = None
+
+    def _prepare(self, record: Dict) -> Dict:
+        return {k: json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list, tuple)) else v
+                for k, v in record.items()}
+
+    def __next_file(self) -> str:
+        while True:
+            file = self.__base + self.__ext if self.__number == 0 else f"{self.__base}.{self.__number}{self.__ext}"
+            self.__number += 1
+            if not os.path.exists(file):
+                return file
+
+    def _write_batch(self, batch: List[Dict]):
+        if self.__schema is None:
+            schema = self.__pa.Table.from_pylist(batch).schema
+            # columns that were None in the whole first batch are assumed to be strings
+            self.__schema = self.__pa.schema([
+                field.with_type(self.__pa.string()) if self.__pa.types.is_null(field.type) else field
+                for field in schema])
+        unknown = set().union(*batch) - set(self.__schema.names)
+        if unknown:
+            _log.warning("Fields that are not in the Parquet schema are dropped: %s", sorted(unknown))
+        file = self.__next_file()
+        self.__pq.write_table(self.__pa.Table.from_pylist(batch, schema=self.__schema), file + ".part")
+        os.replace(file + ".part", file)
+
+
+def open_sink(records: str, output: str, name: str, batch_size: int = 1000, backend: str = 'files',
+              shard_size: int = 1024 ** 3) -> RecordSink:
+    """
+    :param records: format of the records, one of FORMATS
+    :param output: the output folder
+    :param name: file name of the records without extension, if they are written to one file
+    :param batch_size: number of records that are written at once
+    :param backend: one of BACKENDS, "tar" writes records and images to tar shards in "<output>/shards"
+                    and ignores records
+    :param shard_size: maximal size of a tar shard in bytes
+    """
+    if backend == 'tar':
+        from .shards import TarShardSink
+        return TarShardSink(os.path.join(output, "shards"), shard_size=shard_size)
+    if backend != 'files':
+        raise ValueError(f"Unsupported output backend: '{backend}'")
+    if records == 'json':
+        return JsonFileSink(output)
+    if records.startswith('jsonl'):
+        return JsonLinesSink(os.path.join(output, f"{name}.{records}"), batch_size=batch_size)
+    if records == 'parquet':
+        return ParquetSink(os.path.join(output, f"{name}.parquet"), batch_size=batch_size)
+    raise ValueError(f"Unsupported record format: '{records}'")
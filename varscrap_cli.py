@@ -2,6 +2,7 @@ import argparse
 import logging
 
 import varscrap
+from varscrap.sinks import BACKENDS, FORMATS
 
 if __name__ == '__main__':
     cli = argparse.ArgumentParser()
@@ -19,14 +20,12 @@ if __name__ == '__main__':
 
     cli.add_argument(
         "-in", "--input-file",
-        help="Set the input csv file as exported by Zotero",
-        required=True
+        help="Set the input csv file as exported by Zotero"
     )
 
     cli.add_argument(
         "-o", "--output",
-        help="Where the output should be written to",
-        required=True
+        help="Where the output should be written to"
     )
 
     cli.add_argument(
@@ -36,8 +35,157 @@ if __name__ == '__main__':
         action="store_true"
     )
 
+    cli.add_argument(
+        "--concurrency",
+        help="Number of items that are processed at the same time",
+        type=int,
+        default=1
+    )
+
+    cli.add_argument(
+        "--pool-size",
+        help="Number of keep-alive connections per host",
+        type=int,
+        default=10
+    )
+
+    cli.add_argument(
+        "--cache",
+        help="Folder of a persistent HTTP response cache that is shared between runs"
+    )
+
+    cli.add_argument(
+        "--cache-size",
+        help="Maximal size of the response cache in MB",
+        type=int,
+        default=1024
+    )
+
+    cli.add_argument(
+        "--blob-store",
+        help="Folder where every image is stored once and linked into the output folders"
+    )
+
+    cli.add_argument(
+        "--browsers",
+        help="Number of headless browsers that harvest the Hermitage search results at the same time",
+        type=int,
+        default=1
+    )
+
+    cli.add_argument(
+        "--min-concurrency",
+        help="Lower bound of the adaptive number of Hermitage workers",
+        type=int,
+        default=1
+    )
+
+    cli.add_argument(
+        "--max-concurrency",
+        help="Upper bound of the adaptive number of Hermitage workers",
+        type=int,
+        default=10
+    )
+
+    cli.add_argument(
+        "--stats-interval",
+        help="Seconds between two updates of stats.json in the output folder, 0 writes it only at the end",
+        type=float,
+        default=10
+    )
+
+    cli.add_argument(
+        "--metrics-port",
+        help="Serve the metrics in the Prometheus text format on this port while scraping",
+        type=int
+    )
+
+    cli.add_argument(
+        "--records",
+        help="How the metadata of the objects is written: a json file per object or one JSON Lines "
+             "(optionally compressed) or Parquet file",
+        choices=FORMATS,
+        default='json'
+    )
+
+    cli.add_argument(
+        "--batch-size",
+        help="Number of records that are written at once to a JSON Lines or Parquet file",
+        type=int,
+        default=1000
+    )
+
+    cli.add_argument(
+        "--backend",
+        help="Where records and images are stored: loose files in the output folder or tar shards "
+             "(WebDataset style) in its 'shards' folder",
+        choices=BACKENDS,
+        default='files'
+    )
+
+    cli.add_argument(
+        "--shard-size",
+        help="Maximal size of a tar shard in MB",
+        type=int,
+        default=1024
+    )
+
+    cli.add_argument(
+        "--shard",
+        help="i/N: run as worker i (counted from 0) of N workers that share the input, "
+             "writing to the folder shard-i-of-N in the output folder"
+    )
+
+    cli.add_argument(
+        "--variant",
+        help="name=size[:format[:quality]]: make a variant of every image whose longer side is at most size pixels "
+             "('orig' only re-encodes), e.g. train=1024 or thumb=128:webp, written as <image>.<name>.<ext> "
+             "and added as a column to the annotation csv; can be given several times (needs Pillow)",
+        dest="variants",
+        action="append"
+    )
+
+    cli.add_argument(
+        "--image-processes",
+        help="Number of processes that make the image variants, one per core by default",
+        type=int
+    )
+
+    cli.add_argument(
+        "--delta",
+        help="Only scrape the objects that are new since the last delta run and patch the tags of the others",
+        default=False,
+        action="store_true"
+    )
+
+    cli.add_argument(
+        "--lookup-batch",
+        help="Number of V&A objects whose API fields are looked up with one search request, "
+             "1 calls the API once per object",
+        type=int,
+        default=1
+    )
+
+    cli.add_argument(
+        "--jobs",
+        help="Json file with several scraper runs (scraper, input and output folder each) that run at the same "
+             "time in this process, with budgets for the requests in flight per host and in total"
+    )
+
+    cli.add_argument(
+        "--merge",
+        help="Merge the annotation csv files of all worker folders in the output folder instead of scraping",
+        default=False,
+        action="store_true"
+    )
+
     args = cli.parse_args()
 
+    if args.jobs is None and args.output is None:
+        cli.error("the following arguments are required: -o/--output")
+    if args.jobs is None and not args.merge and args.input_file is None:
+        cli.error("the following arguments are required: -in/--input-file")
+
     log_conf = dict(
         level=getattr(logging, args.loglevel.upper(), None),
         format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
@@ -47,15 +195,60 @@ if __name__ == '__main__':
 
     log = logging.getLogger(__name__)
 
-    log.info(f"Running scraping with the options: "
-             f"scrape={args.scrape} "
-             f"input-file={args.input_file} "
-             f"output={args.output} "
-             f"overwrite={args.overwrite} ")
+    if args.jobs is not None:
+        log.info(f"Running the jobs in {args.jobs}")
+        varscrap.run_jobs(args.jobs)
+    elif args.merge:
+        log.info(f"Merging the worker folders in {args.output}")
+        varscrap.merge(args.output)
+    else:
+        log.info(f"Running scraping with the options: "
+                 f"scrape={args.scrape} "
+                 f"input-file={args.input_file} "
+                 f"output={args.output} "
+                 f"overwrite={args.overwrite} "
+                 f"concurrency={args.concurrency} "
+                 f"pool-size={args.pool_size} "
+                 f"cache={args.cache} "
+                 f"cache-size={args.cache_size} "
+                 f"blob-store={args.blob_store} "
+                 f"browsers={args.browsers} "
+                 f"min-concurrency={args.min_concurrency} "
+                 f"max-concurrency={args.max_concurrency} "
+                 f"stats-interval={args.stats_interval} "
+                 f"metrics-port={args.metrics_port} "
+                 f"records={args.records} "
+                 f"batch-size={args.batch_size} "
+                 f"backend={args.backend} "
+                 f"shard-size={args.shard_size} "
+                 f"shard={args.shard} "
+                 f"delta={args.delta} "
+                 f"variants={args.variants} "
+                 f"image-processes={args.image_processes} "
+                 f"lookup-batch={args.lookup_batch} ")
 
-    varscrap.run(
-        scrape=args.scrape,
-        input_file=args.input_file,
-        output_folder=args.output,
-        overwrite=args.overwrite
-    )
+        varscrap.run(
+            scrape=args.scrape,
+            input_file=args.input_file,
+            output_folder=args.output,
+            overwrite=args.overwrite,
+            concurrency=args.concurrency,
+            pool_size=args.pool_size,
+            cache_dir=args.cache,
+            cache_size=args.cache_size * 1024 ** 2,
+            blob_store=args.blob_store,
+            browsers=args.browsers,
+            min_concurrency=args.min_concurrency,
+            max_concurrency=args.max_concurrency,
+            stats_interval=args.stats_interval,
+            metrics_port=args.metrics_port,
+            records=args.records,
+            batch_size=args.batch_size,
+            backend=args.backend,
+            shard_size=args.shard_size * 1024 ** 2,
+            shard=args.shard,
+            delta=args.delta,
+            image_variants=args.variants,
+            image_processes=args.image_processes,
+            lookup_batch=args.lookup_batch
+        )